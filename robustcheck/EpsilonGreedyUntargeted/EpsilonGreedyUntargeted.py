@@ -1,6 +1,10 @@
 import numpy as np
-import random
 from robustcheck.types.UntargetedAttack import UntargetedAttack
+from robustcheck.EpsilonGreedyUntargeted.utils import is_pixel_groups_array, pixel_groups_to_array
+
+# Maximum number of select_group calls whose random draws are precomputed at once. Attacks often stop long before their
+# last step, so drawing the schedule in blocks bounds the memory it uses.
+SELECTION_SCHEDULE_BLOCK_SIZE = 256
 
 
 class EpsilonGreedyUntargeted(UntargetedAttack):
@@ -19,12 +23,20 @@ class EpsilonGreedyUntargeted(UntargetedAttack):
         label: An integer representing the correct class index of the image.
         pixel_groups: An array of arrays of pairs of integers. Each second level array represents the indices of pixels
             that get attacked as part of the same pixel group. Usual approaches are to have these groups created based
-            on objectness or on spatial proximity (e.g. in a grid-like setup).
+            on objectness or on spatial proximity (e.g. in a grid-like setup). The padded array representation
+            (pixel_groups_array, group_sizes) returned by utils.get_grid_pixel_groups_array is accepted as well, and is
+            shared rather than copied. The list representation gets converted to it at initialisation (RobustnessCheck
+            converts it once for all the attacks it runs).
         epsilon: A float representing the probability of exploration (choosing a random group of pixels to be perturbed)
             in the classic epsilon-greedy strategy.
         pixel_space_max: A number (integer or float) representing the maximum value pixels can take in the image space.
             This is used for extracting normalised metrics about the attack success later on.
+        candidates_per_step: An integer representing how many pixel groups are explored in each attack step. All the
+            candidates of a step are predicted in a single batched model call, which amortises the per-call overhead
+            of the model. Each candidate counts as one query. The default of 1 gives the classic epsilon-greedy attack.
         verbose: A boolean flag which, when set to True, enables printing info on the attack results.
+        initial_proba: Optional array of floats representing the model output for the unperturbed image, used instead
+            of querying the model for it (see UntargetedAttack).
 
     Methods:
         get_best_candidate(self): Returns the fittest individual in the active generation.
@@ -45,16 +57,22 @@ class EpsilonGreedyUntargeted(UntargetedAttack):
             pixel_space_min=0,
             pixel_space_max=255,
             steps=1000,
-            verbose=False
+            candidates_per_step=1,
+            verbose=False,
+            initial_proba=None,
     ):
-        UntargetedAttack.__init__(self, model, img, label)  # Each instance encapsulates the model and image to perturb
+        # Each instance encapsulates the model and image to perturb
+        UntargetedAttack.__init__(self, model, img, label, initial_proba)
 
         self._perturbed_img = np.copy(img)  # self._perturbed_img is the variable we will iteratively perturb
-        self._model_perturbed_prediction = self.model.predict(np.array([self._perturbed_img]))[0]
+        self._model_perturbed_prediction = self._get_initial_prediction()
+        # The predicted label is cached and only recomputed when the prediction of the perturbed image changes
+        self._perturbed_pred_label = int(np.argmax(self._model_perturbed_prediction))
         self.queries = 1
 
         self.pixel_groups = pixel_groups
-        self.number_groups = len(self.pixel_groups)
+        self._load_pixel_groups_array()
+        self.number_groups = len(self._group_sizes)
 
         assert 0 <= epsilon <= 1  # epsilon is a probability (of exploration), needs to be between 0 and 1
         self.epsilon = epsilon
@@ -65,13 +83,49 @@ class EpsilonGreedyUntargeted(UntargetedAttack):
 
         self.steps = steps
 
+        assert candidates_per_step >= 1  # Each attack step needs to explore at least one pixel group
+        self.candidates_per_step = candidates_per_step
+
         self.verbose = verbose
 
         # self._values contains the historical average rewards per pixel group
-        self._values = [0.0 for _ in range(self.number_groups)]
+        self._values = np.zeros(self.number_groups, dtype=np.float64)
 
         # self._counts contains the historical count of explorations per pixel group
-        self._counts = [0 for _ in range(self.number_groups)]
+        self._counts = np.zeros(self.number_groups, dtype=np.int64)
+
+        # The groups sharing the highest value are tracked incrementally by update, such that exploitation steps do
+        # not scan all the group values. self._max_group_positions maps each of them to its index in self._max_groups.
+        self._reset_max_groups()
+
+        self._trial_index = 0
+        self._staged_candidates = None
+
+        # Reusable (K, H, W, C) buffer for batched steps. Its rows are kept equal to self._perturbed_img between steps
+        # by restoring only the pixels that were perturbed, so no full image copy is needed per step.
+        self._candidates_buffer = None
+
+        # All the randomness of the attack is drawn from a NumPy generator, in bulk wherever possible
+        self._rng = np.random.default_rng()
+
+        # The exploration decisions and random draws of select_group are precomputed in blocks of steps
+        self._draw_selection_schedule()
+
+    def _load_pixel_groups_array(self):
+        # The array representation of the pixel groups is shared when it is given, and converted otherwise
+        if is_pixel_groups_array(self.pixel_groups):
+            self._pixel_groups_array, self._group_sizes = self.pixel_groups
+        else:
+            self._pixel_groups_array, self._group_sizes = pixel_groups_to_array(self.pixel_groups)
+
+    def _draw_selection_schedule(self):
+        schedule_size = min(max(self.steps, 1) * self.candidates_per_step, SELECTION_SCHEDULE_BLOCK_SIZE)
+        # The schedules are stored as lists, which are faster than arrays to index one element at a time
+        self._explore_schedule = (self._rng.random(schedule_size) <= self.epsilon).tolist()
+        self._random_groups_schedule = self._rng.integers(0, self.number_groups, size=schedule_size).tolist()
+        # Uniform draws in [0, 1) used to pick one of the tied highest-value groups when exploiting
+        self._tie_break_schedule = self._rng.random(schedule_size).tolist()
+        self._selection_index = 0
 
     def select_group(self):
         """
@@ -79,14 +133,21 @@ class EpsilonGreedyUntargeted(UntargetedAttack):
         epsilon-greedy strategies. Here, exploration is represented by sampling a random group of pixels, while
         exploitation means selecting a group of pixels with the highest average reward observed so far.
         """
-        if random.random() > self.epsilon:
+        if self._selection_index == len(self._explore_schedule):
+            # The current block of the schedule is used up (or was released), so the next block is drawn
+            self._draw_selection_schedule()
+
+        selection_index = self._selection_index
+        self._selection_index += 1
+
+        if not self._explore_schedule[selection_index]:
             # Pick a pixel group with the highest historical reward with probability 1 - self.epsilon.
-            max_reward_indices = np.flatnonzero(np.array(self._values) == np.max(np.array(self._values)))
-            max_group_index = np.random.choice(max_reward_indices)
+            tie_index = int(self._tie_break_schedule[selection_index] * len(self._max_groups))
+            max_group_index = self._max_groups[tie_index]
             return max_group_index
         else:
             # Pick a random pixel group with probability self.epsilon.
-            random_group_index = random.randrange(self.number_groups)
+            random_group_index = self._random_groups_schedule[selection_index]
             return random_group_index
 
     def update(self, chosen_group, reward):
@@ -101,27 +162,58 @@ class EpsilonGreedyUntargeted(UntargetedAttack):
         Returns:
             A float representing the updated value of the historical average reward of the chosen group.
         """
-        self._counts[chosen_group] = self._counts[chosen_group] + 1
-
+        self._counts[chosen_group] += 1
         n = self._counts[chosen_group]
-        value = self._values[chosen_group]
 
-        new_value = ((n - 1) / float(n)) * value + (1 / float(n)) * reward
-        self._values[chosen_group] = new_value
+        # Incremental mean update, equivalent to ((n - 1) / n) * value + (1 / n) * reward
+        self._values[chosen_group] += (reward - self._values[chosen_group]) / n
+        new_value = self._values[chosen_group]
+
+        if new_value > self._max_value:
+            self._max_value = new_value
+            self._max_groups = [chosen_group]
+            self._max_group_positions = {chosen_group: 0}
+        elif new_value == self._max_value:
+            if chosen_group not in self._max_group_positions:
+                self._max_group_positions[chosen_group] = len(self._max_groups)
+                self._max_groups.append(chosen_group)
+        elif chosen_group in self._max_group_positions:
+            # The group dropped below the highest value: swap it with the last tied group and pop it. Only when no tied
+            # group is left, the highest value is searched again among all the groups.
+            position = self._max_group_positions.pop(chosen_group)
+            last_group = self._max_groups.pop()
+            if last_group != chosen_group:
+                self._max_groups[position] = last_group
+                self._max_group_positions[last_group] = position
+            if not self._max_groups:
+                self._reset_max_groups()
+
         return new_value
 
-    def explore_attack_group(self, group_index):
+    def _reset_max_groups(self):
+        self._max_value = self._values.max()
+        self._max_groups = np.flatnonzero(self._values == self._max_value).tolist()
+        self._max_group_positions = {group: position for position, group in enumerate(self._max_groups)}
+
+    def explore_attack_group(self, group_index, return_altered_image=True):
         """
-        Explores the potential reward obtained by sampling the attacked pixel from a fixed group.
+        Explores the potential reward obtained by sampling the attacked pixel from a fixed group. The candidate pixel
+        value is written in place into the perturbed image for the model query and rolled back afterwards, so the
+        perturbed image is left unchanged. A copy of the perturbed image is only made for the returned
+        "altered_image", which can be skipped.
 
         Args:
             group_index: An integer representing the index of the pixel group that the method will attempt perturbing.
+            return_altered_image: A boolean flag which, when set to False, leaves "altered_image" out of the returned
+                dictionary, such that no copy of the image is made.
         Returns:
             A dictionary containing information about the perturbation attempt. The dictionary contains the following
             fields:
                 "potential_reward": A float representing the expected reward by perturbing the target group.
                 "altered_image": A three-dimensional array representing the perturbed image after applying the
-                    group_index group perturbation.
+                    group_index group perturbation. Only present when return_altered_image is True.
+                "attack_pixel": A pair of integers representing the indices of the perturbed pixel.
+                "pixel_value": An array representing the candidate channel values of the perturbed pixel.
                 "prob_before": A float representing the probability of the perturbed image to be classified correctly
                     by the target model before applying the group_index group perturbation.
                 "prob_after": A float representing the probability of the perturbed image to be classified correctly
@@ -129,37 +221,185 @@ class EpsilonGreedyUntargeted(UntargetedAttack):
                 "pred_after": An array of floats representing the probability distribution of the perturbed image as
                     output by the target model after applying the group_index group perturbation.
         """
-        attack_group = self.pixel_groups[group_index]
-        count_pixels_group = len(attack_group)
-        attack_pixel_index = random.randrange(count_pixels_group)
-        attack_pixel = attack_group[attack_pixel_index]
+        attack_result = self.explore_attack_groups([group_index])
+
+        exploration_result = {
+            "potential_reward": attack_result["potential_rewards"][0],
+            "attack_pixel": tuple(attack_result["attack_pixels"][0]),
+            "pixel_value": attack_result["pixel_values"][0],
+            "prob_before": attack_result["prob_before"],
+            "prob_after": attack_result["probs_after"][0],
+            "pred_after": attack_result["preds_after"][0]
+        }
+
+        if return_altered_image:
+            altered_image = np.copy(self._perturbed_img)
+            altered_image[exploration_result["attack_pixel"]] = exploration_result["pixel_value"]
+            exploration_result["altered_image"] = altered_image
+
+        return exploration_result
+
+    def explore_attack_groups(self, group_indices):
+        """
+        Batched version of explore_attack_group: explores the potential rewards obtained by sampling one attacked pixel
+        from each of the given groups. All the candidate perturbations are evaluated against the current perturbed
+        image in a single model call, and the perturbed image is left unchanged.
+
+        Args:
+            group_indices: A list of integers representing the indices of the pixel groups that the method will attempt
+                perturbing. Each group gives rise to one candidate image.
+        Returns:
+            A dictionary containing information about the perturbation attempts. The dictionary contains the following
+            fields:
+                "group_indices": The list of explored pixel group indices.
+                "potential_rewards": An array of floats representing the expected reward of each candidate.
+                "attack_pixels": An array of integer pairs representing the indices of the perturbed pixel of each
+                    candidate.
+                "pixel_values": An array representing the candidate channel values of each perturbed pixel.
+                "prob_before": A float representing the probability of the perturbed image to be classified correctly
+                    by the target model before applying any of the candidate perturbations.
+                "probs_after": An array of floats representing the probabilities of the candidates to be classified
+                    correctly by the target model.
+                "preds_after": An array of arrays of floats representing the probability distributions of the
+                    candidates as output by the target model.
+        """
+        candidate_next_perturbed_imgs = self._stage_candidates(group_indices)
+        preds_after = self.predict_fn(candidate_next_perturbed_imgs)
+        return self._evaluate_staged_candidates(preds_after)
+
+    def _stage_candidates(self, group_indices):
+        """
+        Samples one attacked pixel and its candidate value for each of the given groups, and returns the batch of
+        candidate images to be evaluated by the model. The sampled perturbations are kept until the matching
+        _evaluate_staged_candidates call.
+        """
+        candidates_count = len(group_indices)
+        candidate_indices = np.arange(candidates_count)
 
-        candidate_next_perturbed_img = self._perturbed_img.copy()
+        if self._pixel_groups_array is None:
+            self._load_pixel_groups_array()
 
-        for ch in range(np.shape(self.img)[2]):
-            value = (
-                random.randint(int(self.pixel_space_min), int(self.pixel_space_max))
-                if self.pixel_space_int_flag
-                else random.uniform(self.pixel_space_min, self.pixel_space_max)
+        attack_pixel_indices = self._rng.integers(0, self._group_sizes[group_indices])
+        attack_pixels = self._pixel_groups_array[group_indices, attack_pixel_indices]
+
+        values_size = (candidates_count, self._channels)
+        if self.pixel_space_int_flag:
+            values = self._rng.integers(
+                int(self.pixel_space_min), int(self.pixel_space_max), size=values_size, endpoint=True
             )
-            candidate_next_perturbed_img[attack_pixel[0]][attack_pixel[1]][ch] = value
+        else:
+            values = self._rng.uniform(self.pixel_space_min, self.pixel_space_max, size=values_size)
+
+        if candidates_count == 1:
+            # A single candidate is written in place into the perturbed image and rolled back after its evaluation
+            pixel_i, pixel_j = attack_pixels[0]
+            original_pixel_value = self._perturbed_img[pixel_i, pixel_j].copy()
+            self._perturbed_img[pixel_i, pixel_j] = values[0]
+            candidate_next_perturbed_imgs = np.expand_dims(self._perturbed_img, axis=0)
+        else:
+            original_pixel_value = None
+            if self._candidates_buffer is None or len(self._candidates_buffer) != candidates_count:
+                self._candidates_buffer = np.repeat(
+                    np.expand_dims(self._perturbed_img, axis=0), candidates_count, axis=0
+                )
+            candidate_next_perturbed_imgs = self._candidates_buffer
+            candidate_next_perturbed_imgs[candidate_indices, attack_pixels[:, 0], attack_pixels[:, 1]] = values
+
+        self._staged_candidates = {
+            "group_indices": group_indices,
+            "attack_pixels": attack_pixels,
+            # The values as stored in the image dtype
+            "pixel_values": candidate_next_perturbed_imgs[candidate_indices, attack_pixels[:, 0], attack_pixels[:, 1]],
+            "original_pixel_value": original_pixel_value,
+        }
+        return candidate_next_perturbed_imgs
 
-        correct_class_prob_before = self._model_perturbed_prediction[self.label]
+    def _evaluate_staged_candidates(self, preds_after):
+        """
+        Computes the potential rewards of the staged candidates given their predictions (see explore_attack_groups for
+        the returned dictionary), and rolls back any in-place candidate perturbation.
+        """
+        staged_candidates = self._staged_candidates
+        self._staged_candidates = None
 
-        pred_after = self.model.predict(np.array([candidate_next_perturbed_img]))[0]
-        self.queries += 1
+        attack_pixels = staged_candidates["attack_pixels"]
+        if staged_candidates["original_pixel_value"] is not None:
+            pixel_i, pixel_j = attack_pixels[0]
+            self._perturbed_img[pixel_i, pixel_j] = staged_candidates["original_pixel_value"]
+        else:
+            candidate_indices = np.arange(len(attack_pixels))
+            self._candidates_buffer[candidate_indices, attack_pixels[:, 0], attack_pixels[:, 1]] = \
+                self._perturbed_img[attack_pixels[:, 0], attack_pixels[:, 1]]
+
+        self.queries += len(preds_after)
 
-        correct_class_prob_after = pred_after[self.label]
-        potential_reward = correct_class_prob_before - correct_class_prob_after
+        correct_class_prob_before = self._model_perturbed_prediction[self.label]
+        correct_class_probs_after = preds_after[:, self.label]
+        potential_rewards = correct_class_prob_before - correct_class_probs_after
 
         return {
-            "potential_reward": potential_reward,
-            "altered_image": candidate_next_perturbed_img,
+            "group_indices": staged_candidates["group_indices"],
+            "potential_rewards": potential_rewards,
+            "attack_pixels": staged_candidates["attack_pixels"],
+            "pixel_values": staged_candidates["pixel_values"],
             "prob_before": correct_class_prob_before,
-            "prob_after": correct_class_prob_after,
-            "pred_after": pred_after
+            "probs_after": correct_class_probs_after,
+            "preds_after": preds_after
         }
 
+    def propose_candidates(self):
+        """
+        Selects candidates_per_step pixel groups and returns the batch of candidate images of the next attack step, or
+        None if the attack has finished.
+        """
+        if self._trial_index >= self.steps or self.is_perturbed():
+            self._release_step_buffers()
+            return None
+
+        # Select the target pixel groups to perturb
+        attack_groups = [self.select_group() for _ in range(self.candidates_per_step)]
+        return self._stage_candidates(attack_groups)
+
+    def receive_predictions(self, predictions):
+        """
+        Completes the attack step started by propose_candidates. The candidate with the highest positive reward (if
+        any) is applied, and all the explored groups are updated with their observed rewards.
+
+        Args:
+            predictions: An array of arrays of floats representing the probability distributions output by the target
+                model for the candidates returned by propose_candidates.
+        """
+        attack_result = self._evaluate_staged_candidates(predictions)
+
+        potential_rewards = attack_result["potential_rewards"]
+        best_candidate_index = np.argmax(potential_rewards)
+
+        # Only update the perturbed image self._perturbed_img if the best potential reward is positive
+        if potential_rewards[best_candidate_index] > 0:
+            pixel_i, pixel_j = attack_result["attack_pixels"][best_candidate_index]
+            self._perturbed_img[pixel_i, pixel_j] = attack_result["pixel_values"][best_candidate_index]
+            if self._candidates_buffer is not None:
+                self._candidates_buffer[:, pixel_i, pixel_j] = self._perturbed_img[pixel_i, pixel_j]
+            self._model_perturbed_prediction = attack_result["preds_after"][best_candidate_index]
+            self._perturbed_pred_label = int(np.argmax(self._model_perturbed_prediction))
+
+        # Update the average historical reward of the target pixel groups no matter if the reward was positive or not
+        for attack_group, potential_reward in zip(attack_result["group_indices"], potential_rewards):
+            self.update(attack_group, potential_reward)
+
+        self._trial_index += 1
+
+    def _release_step_buffers(self):
+        # Finished attacks are kept by RobustnessCheck, so the buffers only needed while running are freed, including
+        # the pixel groups array converted from list-form pixel groups. They are rebuilt on demand if the attack is
+        # stepped again.
+        self._explore_schedule = []
+        self._random_groups_schedule = []
+        self._tie_break_schedule = []
+        self._selection_index = 0
+        self._candidates_buffer = None
+        self._pixel_groups_array = None
+
     def run_adversarial_attack(self):
         """
         Runs the adversarial attack.
@@ -168,25 +408,12 @@ class EpsilonGreedyUntargeted(UntargetedAttack):
              An integer representing the number of attack steps until either the attack was successful or the maximum
              steps threshold was reached.
         """
-        trial_index = 0
-        while trial_index < self.steps and not self.is_perturbed():
-            attack_group = self.select_group()  # Select the target pixel group to perturb
-
-            # Simulate attacking the target pixel group and retrieve the potential reward
-            attack_result = self.explore_attack_group(attack_group)
+        candidates = self.propose_candidates()
+        while candidates is not None:
+            self.receive_predictions(self.predict_fn(candidates))
+            candidates = self.propose_candidates()
 
-            potential_reward = attack_result["potential_reward"]
-            altered_image = attack_result["altered_image"]
-
-            # Only update the perturbed image self._perturbed_img if the potential reward is positive
-            if potential_reward > 0:
-                self._perturbed_img = altered_image
-                self._model_perturbed_prediction = attack_result["pred_after"]
-
-            # Update the average historical reward of the target pixel group no matter if the reward was positive or not
-            self.update(attack_group, potential_reward)
-
-            trial_index += 1
+        trial_index = self._trial_index
 
         if self.is_perturbed() and self.verbose:
             print(f"Image successfully perturbed in {trial_index} rounds")
@@ -207,8 +434,7 @@ class EpsilonGreedyUntargeted(UntargetedAttack):
         Returns:
             A boolean representing whether the adversarial attack has been successful
         """
-        pred_label = np.argmax(self._model_perturbed_prediction)
-        correct_output = (pred_label == self.label)
-        return not correct_output
+        return self._perturbed_pred_label != self.label
 
     # TODO: move to /attacks module together with EvoStrategyUniformUntargeted, keep only RobustnessCheck in main folder
+
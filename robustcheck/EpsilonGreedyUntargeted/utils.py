@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 
 def get_grid_pixel_groups(patch_size, image_size):
@@ -11,19 +12,101 @@ def get_grid_pixel_groups(patch_size, image_size):
         image_size: A tuple of two integers representing the size of the image to be patched.
 
     Returns:
-        A list of lists of integer pairs, each list of integer pairs representing pixel indices belonging to the same
-            rectangular patch.
-    """
-    pixel_groups = []
-    for i in range(math.ceil(image_size[0] / patch_size[0])):
-        for j in range(math.ceil(image_size[1] / patch_size[1])):
-            current_group = []
-            for pixel_i_delta in range(patch_size[0]):
-                for pixel_j_delta in range(patch_size[1]):
-                    pixel_i = patch_size[0] * i + pixel_i_delta
-                    pixel_j = patch_size[1] * j + pixel_j_delta
-                    if pixel_i < image_size[0] and pixel_j < image_size[1]:
-                        current_group.append((pixel_i, pixel_j))
-            pixel_groups.append(current_group)
-
-    return pixel_groups
+        A list of integer arrays of shape (group_size, 2), each array holding the pixel indices (i, j) belonging to the
+            same rectangular patch in row-major order. Patches are listed in row-major order of the grid.
+    """
+    grid_cols = math.ceil(image_size[1] / patch_size[1])
+
+    # Group index of every pixel, computed for the whole image at once
+    pixel_i, pixel_j = np.mgrid[0:image_size[0], 0:image_size[1]]
+    group_ids = (pixel_i // patch_size[0]) * grid_cols + (pixel_j // patch_size[1])
+
+    # A stable sort keeps the pixels of each group in row-major order
+    order = np.argsort(group_ids, axis=None, kind="stable")
+    coordinates = np.stack([pixel_i.ravel()[order], pixel_j.ravel()[order]], axis=1)
+    group_sizes = np.bincount(group_ids.ravel())
+
+    return np.split(coordinates, np.cumsum(group_sizes)[:-1])
+
+
+def get_grid_pixel_groups_array(patch_size, image_size):
+    """
+    Array version of get_grid_pixel_groups: generates the same grid of rectangles of size patch_size covering an image
+    of size image_size, but stores the pixel indices of all the groups in a single padded array.
+
+    Args:
+        patch_size: A tuple of two integers representing the size of the rectangle that will be used to patch the image
+            and generate a rectangular grid
+        image_size: A tuple of two integers representing the size of the image to be patched.
+
+    Returns:
+        A tuple (pixel_groups_array, group_sizes). pixel_groups_array is an integer array of shape
+            (number_groups, max_group_size, 2) where the first group_sizes[g] rows of pixel_groups_array[g] are the
+            pixel indices belonging to group g, and the remaining rows are padding. group_sizes is an integer array of
+            shape (number_groups,).
+    """
+    grid_rows = math.ceil(image_size[0] / patch_size[0])
+    grid_cols = math.ceil(image_size[1] / patch_size[1])
+
+    # Pixel coordinates of the image padded up to a whole number of patches, in row-major order
+    pixel_i, pixel_j = np.meshgrid(
+        np.arange(grid_rows * patch_size[0], dtype=np.int32),
+        np.arange(grid_cols * patch_size[1], dtype=np.int32),
+        indexing="ij",
+    )
+
+    def to_groups(coordinates):
+        # (grid_rows * patch_h, grid_cols * patch_w) -> (grid_rows * grid_cols, patch_h * patch_w)
+        return (
+            coordinates.reshape(grid_rows, patch_size[0], grid_cols, patch_size[1])
+            .transpose(0, 2, 1, 3)
+            .reshape(grid_rows * grid_cols, patch_size[0] * patch_size[1])
+        )
+
+    group_i = to_groups(pixel_i)
+    group_j = to_groups(pixel_j)
+    valid = (group_i < image_size[0]) & (group_j < image_size[1])
+
+    # Move the pixels that fall outside the image (only in the patches on the bottom and right edges) to the end of
+    # their group, keeping the row-major order of the valid ones
+    order = np.argsort(~valid, axis=1, kind="stable")
+    pixel_groups_array = np.stack(
+        [np.take_along_axis(group_i, order, axis=1), np.take_along_axis(group_j, order, axis=1)], axis=-1
+    )
+    group_sizes = np.count_nonzero(valid, axis=1).astype(np.int32)
+    pixel_groups_array[~np.take_along_axis(valid, order, axis=1)] = 0
+
+    return pixel_groups_array[:, :group_sizes.max()], group_sizes
+
+
+def pixel_groups_to_array(pixel_groups):
+    """
+    Converts pixel groups given as a list of lists of integer pairs (as returned by get_grid_pixel_groups) to the
+    padded array representation returned by get_grid_pixel_groups_array.
+
+    Args:
+        pixel_groups: A list of lists of integer pairs, each list representing the pixel indices of one group.
+
+    Returns:
+        A tuple (pixel_groups_array, group_sizes), see get_grid_pixel_groups_array.
+    """
+    group_sizes = np.array([len(group) for group in pixel_groups], dtype=np.int32)
+    pixel_groups_array = np.zeros((len(pixel_groups), group_sizes.max(initial=0), 2), dtype=np.int32)
+    for group_index, group in enumerate(pixel_groups):
+        if len(group) > 0:
+            pixel_groups_array[group_index, :len(group)] = np.asarray(group)
+    return pixel_groups_array, group_sizes
+
+
+def is_pixel_groups_array(pixel_groups):
+    """
+    Returns a boolean representing whether pixel_groups is in the padded array representation returned by
+    get_grid_pixel_groups_array, rather than a list of lists of integer pairs.
+    """
+    # The array representation is a (pixel_groups_array, group_sizes) pair with a three-dimensional first element
+    return (
+        isinstance(pixel_groups, tuple)
+        and len(pixel_groups) == 2
+        and isinstance(pixel_groups[0], np.ndarray)
+        and pixel_groups[0].ndim == 3
+    )
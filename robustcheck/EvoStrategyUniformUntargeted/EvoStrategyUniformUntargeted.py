@@ -1,10 +1,7 @@
 import numpy as np
-import random
-import matplotlib.pyplot as plt
 from robustcheck.types.EvoStrategy import EvoStrategy
 from robustcheck.types.UntargetedAttack import UntargetedAttack
 from robustcheck import utils
-import gc
 
 
 class EvoStrategyUniformUntargeted(EvoStrategy, UntargetedAttack):
@@ -41,6 +38,8 @@ class EvoStrategyUniformUntargeted(EvoStrategy, UntargetedAttack):
             pixel values) are integers. True means they are integers, False means they are floats.
         pixel_space_min: A number (integer or float) representing the minimum value pixels can take in the image space.
         pixel_space_max: A number (integer or float) representing the maximum value pixels can take in the image space.
+        initial_proba: Optional array of floats representing the model output for the unperturbed image, used instead
+            of querying the model for it (see UntargetedAttack).
 
     Methods:
         get_best_candidate(self): Returns the fittest individual in the active generation.
@@ -66,20 +65,24 @@ class EvoStrategyUniformUntargeted(EvoStrategy, UntargetedAttack):
         pixel_space_min=0.0,
         pixel_space_max=1.0,
         clean_memory=True,
+        initial_proba=None,
     ):
         EvoStrategy.__init__(self)
 
         # Each instance encapsulates the model and image to perturb
-        UntargetedAttack.__init__(self, model, img, label)
+        UntargetedAttack.__init__(self, model, img, label, initial_proba)
 
         # Set active generation to the unperturbed image
         self.active_generation = [img]
         self.queries += (
             1  # One query is used for calling predict on the unperturbed image
         )
-        self.fitness_scores = [
-            1 - self.model.predict(np.expand_dims(img, axis=0), verbose=False)[0][label]
-        ]
+
+        # The prediction of the fittest individual is cached such that is_perturbed and the final report do not need
+        # to query the model again. It is refreshed with every batched generation prediction.
+        self._best_prediction = self._get_initial_prediction()
+        self._best_pred_label = np.argmax(self._best_prediction)
+        self.fitness_scores = [1 - self._best_prediction[label]]
 
         self.generation_size = generation_size
         self.one_step_perturbation_pixel_count = one_step_perturbation_pixel_count
@@ -96,13 +99,17 @@ class EvoStrategyUniformUntargeted(EvoStrategy, UntargetedAttack):
 
         self.clean_memory = clean_memory
 
+        # Every generation is written in place into this (G, H, W, C) buffer, allocated lazily by _get_next_generation
+        self._generation_buffer = None
+
+        # All the randomness of the attack is drawn from a NumPy generator, in bulk for whole generations
+        self._rng = np.random.default_rng()
+
         if self.verbose:
             self.print_initial_state()
 
     def print_initial_state(self):
-        img_pred = self.model.predict(np.expand_dims(self.img, axis=0), verbose=False)[
-            0
-        ]
+        img_pred = self._best_prediction
 
         print(utils.PRINT_SEPARATOR)
 
@@ -122,39 +129,53 @@ class EvoStrategyUniformUntargeted(EvoStrategy, UntargetedAttack):
         print(utils.PRINT_SEPARATOR)
 
     def _get_next_generation(self):
-        best_candidate = self.get_best_candidate()
-        new_generation = []
-        for i in range(self.generation_size):
-            offspring = self._get_offspring(best_candidate)
-            new_generation.append(offspring)
+        # The whole generation is built in the reusable (G, H, W, C) buffer: every offspring starts as a copy of the
+        # best candidate and then gets its perturbed pixels written in one vectorised assignment across the generation.
+        if self._generation_buffer is None:
+            self._generation_buffer = np.empty(
+                (self.generation_size, self._height, self._width, self._channels), dtype=self.img.dtype
+            )
+
+        # The best candidate may be a row of the buffer itself, so it is copied before the buffer gets overwritten
+        best_candidate = np.copy(self.get_best_candidate())
+        new_generation = self._generation_buffer
+        new_generation[:] = best_candidate
+
+        pixels_i, pixels_j, values = self._sample_perturbations(
+            (self.generation_size, self.one_step_perturbation_pixel_count)
+        )
+        offspring_indices = np.arange(self.generation_size)[:, np.newaxis]
+        new_generation[offspring_indices, pixels_i, pixels_j] = values
         return new_generation
 
     def _get_fitness_scores(self):
+        # We do batch predictions for entire generations.
+        predictions = self.predict_fn(np.asarray(self.active_generation))
+        return self._get_fitness_scores_from_predictions(predictions)
+
+    def _get_fitness_scores_from_predictions(self, predictions):
         # We define fitness as probability to be anything else than the correct class (self.label),
-        # which is 1 - correct_class_probability. We do batch predictions for entire generations.
-        fitness_scores = 1 - self.model.predict(
-            np.array(self.active_generation), verbose=False
-        )
-        fitness_scores = np.array(list(map(lambda x: x[self.label], fitness_scores)))
-        queries = len(fitness_scores)
+        # which is 1 - correct_class_probability.
+        fitness_scores = 1.0 - predictions[:, self.label]
+        queries = predictions.shape[0]
+
+        best_candidate_index = np.argmax(fitness_scores)
+        self._best_prediction = predictions[best_candidate_index]
+        self._best_pred_label = np.argmax(self._best_prediction)
         return fitness_scores, queries
 
-    def _get_offspring(self, candidate):
-        # Offspring are within one pixel distance from their parent, with gaussian noise being added.
-        shape = np.shape(candidate)
-        candidate_copy = candidate.copy()
-        for perturb_count in range(self.one_step_perturbation_pixel_count):
-            i = random.randint(0, shape[0] - 1)
-            j = random.randint(0, shape[1] - 1)
-            for c in range(np.shape(self.img)[2]):
-                value = (
-                    random.randint(int(self.pixel_space_min), int(self.pixel_space_max))
-                    if self.pixel_space_int_flag
-                    else random.uniform(self.pixel_space_min, self.pixel_space_max)
-                )
-
-                candidate_copy[i][j][c] = value
-        return candidate_copy
+    def _sample_perturbations(self, size):
+        # Samples pixel coordinates of the given size, together with one random value per channel for each pixel
+        pixels_i = self._rng.integers(0, self._height, size=size)
+        pixels_j = self._rng.integers(0, self._width, size=size)
+        values_size = size + (self._channels,)
+        if self.pixel_space_int_flag:
+            values = self._rng.integers(
+                int(self.pixel_space_min), int(self.pixel_space_max), size=values_size, endpoint=True
+            )
+        else:
+            values = self._rng.uniform(self.pixel_space_min, self.pixel_space_max, size=values_size)
+        return pixels_i, pixels_j, values
 
     def _generate_next_generation(self):
         EvoStrategy._generate_next_generation(self)
@@ -163,41 +184,61 @@ class EvoStrategyUniformUntargeted(EvoStrategy, UntargetedAttack):
         return EvoStrategy.get_best_candidate(self)
 
     def is_perturbed(self):
-        best_candidate = self.get_best_candidate()
-        if (
-                np.argmax(
-                    self.model.predict(
-                        np.expand_dims(best_candidate, axis=0), verbose=False
-                    )[0]
-                )
-                != self.label
-        ):
-            return True
-        return False
+        # The label of the fittest individual is cached by _get_fitness_scores_from_predictions, so no query is needed
+        return self._best_pred_label != self.label
 
     def _flush_memory(self):
-        best_candidate = np.copy(self.get_best_candidate())
-        del self.active_generation
-        self.active_generation = [best_candidate]
+        # Only the best row of the generation buffer is kept active. The buffer itself is reused by the next generation.
+        best_candidate_index = np.argmax(self.fitness_scores)
+        self.active_generation = self._generation_buffer[best_candidate_index:best_candidate_index + 1]
         self.fitness_scores = [np.max(self.fitness_scores)]
-        gc.collect()
-
-    def run_adversarial_attack(self):
-        generation_idx = 0
 
-        while generation_idx < self.steps and not self.is_perturbed():
-            self._generate_next_generation()
+    def _release_generation_buffer(self):
+        # Keep a standalone copy of the best candidate and free the generation buffer once the attack is done
+        if self._generation_buffer is None:
+            return
+        self.active_generation = [np.copy(self.get_best_candidate())]
+        self.fitness_scores = [np.max(self.fitness_scores)]
+        self._generation_buffer = None
+
+    def propose_candidates(self):
+        """
+        Generates the next generation and returns it as the batch of candidate images to be evaluated, or None if the
+        attack has finished.
+        """
+        if self.generation_count >= self.steps or self.is_perturbed():
             if self.clean_memory:
-                self._flush_memory()
-            generation_idx += 1
+                self._release_generation_buffer()
+            return None
+
+        self.active_generation = self._get_next_generation()
+        return np.asarray(self.active_generation)
+
+    def receive_predictions(self, predictions):
+        """
+        Completes the generation started by propose_candidates by computing the fitness scores of its individuals.
+
+        Args:
+            predictions: An array of arrays of floats representing the probability distributions output by the target
+                model for the candidates returned by propose_candidates.
+        """
+        self.generation_count += 1
+        self.fitness_scores, queries = self._get_fitness_scores_from_predictions(predictions)
+        self.queries += queries
+        if self.clean_memory:
+            self._flush_memory()
+
+    def run_adversarial_attack(self):
+        candidates = self.propose_candidates()
+        while candidates is not None:
+            self.receive_predictions(self.predict_fn(candidates))
+            candidates = self.propose_candidates()
 
+        generation_idx = self.generation_count
         best_candidate = np.copy(self.get_best_candidate())
 
         if self.verbose:
-            model_pred_best_candidate = self.model.predict(
-                np.expand_dims(best_candidate, axis=0),
-                verbose=False,
-            )
+            model_pred_best_candidate = np.expand_dims(self._best_prediction, axis=0)
             print("After", generation_idx, "generations")
             print(
                 "Label:",
@@ -207,6 +248,9 @@ class EvoStrategyUniformUntargeted(EvoStrategy, UntargetedAttack):
             )
             print("Fitness:", max(self.fitness_scores))
             try:
+                # matplotlib is only imported when the attack results are displayed
+                import matplotlib.pyplot as plt
+
                 plt.subplot(121)
                 if self.reshape_flag:
                     plt.imshow(np.reshape(self.img, self.reshape_dims) / self.pixel_space_max)
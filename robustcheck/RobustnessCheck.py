@@ -1,9 +1,17 @@
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from robustcheck import config
 from tqdm import tqdm
 from robustcheck.utils import PRINT_SEPARATOR
 from robustcheck.utils.metrics import image_distance
+from robustcheck.utils.model import get_predict_fn, is_keras_model
+from robustcheck.EpsilonGreedyUntargeted.utils import is_pixel_groups_array, pixel_groups_to_array
+
+WORKER_TYPES = ("thread", "process")
+
+# Model and attack configuration of a process pool worker, set once per worker by _init_attack_worker
+_worker_state = {}
 
 
 class RobustnessCheck:
@@ -24,6 +32,21 @@ class RobustnessCheck:
         attack_params: A dictionary mapping parameters that the chosen attack expects and values. In case some mandatory
             attack parameters are not specified, these will be filled automatically according to default values that
             can be found in config.DEFAULT_PARAMS.
+        batch_attacks: A boolean flag which, when set to True, runs the attacks against all the images in lock-step:
+            at every step, the candidates of all the still running attacks are evaluated together, in batches of
+            predict_batch_size images. This amortises the per-call overhead of the model over the whole dataset.
+            All the attacks support this through their step-wise interface (see UntargetedAttack.propose_candidates).
+        n_workers: An integer representing how many attacks are run concurrently. Cannot be combined with
+            batch_attacks.
+        worker_type: A string, either "thread" or "process", selecting how the n_workers attacks are run concurrently.
+            Threads only help when the model releases the GIL during inference and can be called from multiple threads
+            at once (e.g. TensorFlow or PyTorch models running in graph or inference mode). Processes suit CPU-bound
+            models that hold the GIL (e.g. scikit-learn or ONNX models on CPU): the model is pickled and sent once to
+            each worker process, so it has to be picklable.
+        predict_batch_size: An integer representing the maximum number of images the model is queried on at once when
+            evaluating its accuracy on x_test, and when evaluating the candidates of a lock-step round with
+            batch_attacks. This bounds the memory used by the model on large datasets, and the memory used to gather the
+            candidates of a lock-step round.
 
     Methods:
         run_robustness_check(self): Runs the specified attack against the model for each image from x_test with
@@ -33,7 +56,18 @@ class RobustnessCheck:
             by run_robustness_check(self). Therefore, it needs run_robustness_check(self) to have completed successfully
             before being called, otherwise it will raise an exception.
     """
-    def __init__(self, model, x_test, y_test, attack, attack_params):
+    def __init__(
+        self,
+        model,
+        x_test,
+        y_test,
+        attack,
+        attack_params,
+        batch_attacks=False,
+        n_workers=1,
+        worker_type="thread",
+        predict_batch_size=64,
+    ):
         self.model = model
         self.x_test = x_test
         self.y_test = y_test
@@ -53,6 +87,21 @@ class RobustnessCheck:
         self.attack = attack
         self.attack_params = attack_params
 
+        self.batch_attacks = batch_attacks
+
+        if n_workers < 1:
+            raise Exception(f"n_workers has to be a positive integer, got {n_workers}")
+
+        if batch_attacks and n_workers > 1:
+            raise Exception("batch_attacks and n_workers > 1 cannot be used together")
+
+        if worker_type not in WORKER_TYPES:
+            raise Exception(f"{worker_type} is not one of the supported worker types: {WORKER_TYPES}")
+
+        self.n_workers = n_workers
+        self.worker_type = worker_type
+        self.predict_batch_size = predict_batch_size
+
         for attack_param_key in config.DEFAULT_PARAMS[attack]:
             if attack_param_key not in self.attack_params:
                 self.attack_params[attack_param_key] = config.DEFAULT_PARAMS[attack][
@@ -61,13 +110,29 @@ class RobustnessCheck:
 
         # TODO: check if attack_params are the ones corresponding to the attack. Map these in robustcheck.config
 
+        # The parameters the attacks are constructed with. List-form pixel groups are converted to their array
+        # representation once here, such that all the attacks share one array instead of converting and keeping a copy
+        self._attack_init_params = dict(self.attack_params)
+        pixel_groups = self._attack_init_params.get("pixel_groups")
+        if pixel_groups is not None and not is_pixel_groups_array(pixel_groups):
+            self._attack_init_params["pixel_groups"] = pixel_groups_to_array(pixel_groups)
+
         print("Running accuracy evaluation")
 
-        proba_outputs = self.model.predict(x_test)
-        self._y_pred = np.argmax(proba_outputs, axis=1)
+        # The model outputs on the clean images are kept, such that the attacks do not need to query them again. Keras
+        # models batch x_test themselves in a single predict call, while other models are queried chunk by chunk.
+        if is_keras_model(self.model):
+            self._proba_outputs = np.asarray(self.model.predict(x_test, batch_size=predict_batch_size, verbose=0))
+        else:
+            self._proba_outputs = np.concatenate([
+                self.model.predict(x_test[batch_start:batch_start + predict_batch_size])
+                for batch_start in range(0, len(x_test), predict_batch_size)
+            ], axis=0)
+        self._y_pred = np.argmax(self._proba_outputs, axis=1)
 
         self._correct_pred_mask = self._y_pred == self.y_test
-        self._accuracy = np.mean(self._correct_pred_mask)
+        self._correct_pred_indices = np.flatnonzero(self._correct_pred_mask).tolist()
+        self._accuracy = len(self._correct_pred_indices) / self._correct_pred_mask.size
 
         print("Accuracy: ", self._accuracy)
 
@@ -88,22 +153,29 @@ class RobustnessCheck:
         attack_class = config.SUPPORTED_ATTACKS[self.attack]
         index_to_adversarial_strategy = {}
 
-        for index in tqdm(range(self._dataset_size)):
-            if self._correct_pred_mask[index]:
-                img = self.x_test[index]
-                label = self.y_test[index]
+        # Only the correctly classified images are attacked
+        if self.n_workers > 1 and self.worker_type == "process":
+            adversarial_strategies = self._run_attacks_in_processes()
+            index_to_adversarial_strategy = dict(zip(self._correct_pred_indices, adversarial_strategies))
+        elif self.n_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+                adversarial_strategies = list(tqdm(
+                    executor.map(self._run_attack, self._correct_pred_indices), total=len(self._correct_pred_indices)
+                ))
+            index_to_adversarial_strategy = dict(zip(self._correct_pred_indices, adversarial_strategies))
+        elif self.batch_attacks:
+            for index in self._correct_pred_indices:
                 index_to_adversarial_strategy[index] = attack_class(
                     model=self.model,
-                    img=img,
-                    label=label,
-                    **self.attack_params,
+                    img=self.x_test[index],
+                    label=self.y_test[index],
+                    initial_proba=self._proba_outputs[index],
+                    **self._attack_init_params,
                 )
-
-                no_steps = index_to_adversarial_strategy[index].run_adversarial_attack()
-
-                assert (
-                    no_steps > 0
-                )  # This should hold as any correctly classified image requires at least one query
+            self._run_attacks_in_lockstep(list(index_to_adversarial_strategy.values()))
+        else:
+            for index in tqdm(self._correct_pred_indices):
+                index_to_adversarial_strategy[index] = self._run_attack(index)
 
         self._index_to_adversarial_strategy = index_to_adversarial_strategy
         stats = self._compute_robustness_stats()
@@ -112,6 +184,121 @@ class RobustnessCheck:
 
         return stats
 
+    def _run_attack(self, index):
+        """
+        Runs the attack against the image with the given index from x_test and returns the finished attack.
+        """
+        return _run_one_attack(
+            self.attack,
+            self.model,
+            self._attack_init_params,
+            self.x_test[index],
+            self.y_test[index],
+            self._proba_outputs[index],
+        )
+
+    def _run_attacks_in_processes(self):
+        """
+        Runs the attacks against the correctly classified images in a pool of n_workers processes and returns the
+        finished attacks, in the order of self._correct_pred_indices.
+        """
+        attack_inputs = [
+            (self.x_test[index], self.y_test[index], self._proba_outputs[index]) for index in self._correct_pred_indices
+        ]
+        chunksize = max(1, len(attack_inputs) // (4 * self.n_workers))
+
+        with ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            initializer=_init_attack_worker,
+            initargs=(self.model, self.attack, self._attack_init_params),
+        ) as executor:
+            adversarial_strategies = list(tqdm(
+                executor.map(_run_one_attack_in_worker, attack_inputs, chunksize=chunksize), total=len(attack_inputs)
+            ))
+
+        # The attacks come back without their model, which is attached again such that they behave as if run locally.
+        # Their pixel groups are replaced by the shared ones, instead of keeping the copy unpickled for each attack.
+        predict_fn = get_predict_fn(self.model)
+        for adversarial_strategy in adversarial_strategies:
+            adversarial_strategy.model = self.model
+            adversarial_strategy.predict_fn = predict_fn
+            if "pixel_groups" in self._attack_init_params:
+                adversarial_strategy.pixel_groups = self._attack_init_params["pixel_groups"]
+
+        return adversarial_strategies
+
+    def _run_attacks_in_lockstep(self, adversarial_strategies):
+        """
+        Runs the given attacks step by step, evaluating the candidates proposed by all the still running attacks
+        together at every step and dispatching each attack its slice of the predictions. The candidates of a step are
+        passed to the model in batches of at most predict_batch_size images.
+        """
+        if len(adversarial_strategies) == 0:
+            return
+
+        # All the attacks target the same model, so the model is queried through the predict_fn of any of them
+        predict_fn = adversarial_strategies[0].predict_fn
+        steps = np.zeros(len(adversarial_strategies), dtype=np.int64)
+        batch_buffer = None
+
+        active_positions = list(range(len(adversarial_strategies)))
+        with tqdm(total=len(adversarial_strategies)) as progress_bar:
+            while len(active_positions) > 0:
+                proposals = []
+                for position in active_positions:
+                    candidates = adversarial_strategies[position].propose_candidates()
+                    if candidates is not None:
+                        proposals.append((position, candidates))
+
+                # Attacks that did not propose any candidates have finished
+                progress_bar.update(len(active_positions) - len(proposals))
+                if len(proposals) == 0:
+                    break
+
+                if batch_buffer is None:
+                    first_candidates = proposals[0][1]
+                    batch_buffer = np.empty(
+                        (self.predict_batch_size,) + first_candidates.shape[1:], dtype=first_candidates.dtype
+                    )
+                predictions = self._predict_proposals(predict_fn, proposals, batch_buffer)
+
+                offset = 0
+                for position, candidates in proposals:
+                    adversarial_strategies[position].receive_predictions(predictions[offset:offset + len(candidates)])
+                    offset += len(candidates)
+                    steps[position] += 1
+
+                active_positions = [position for position, _ in proposals]
+
+        assert np.all(
+            steps > 0
+        )  # This should hold as any correctly classified image requires at least one query
+
+    @staticmethod
+    def _predict_proposals(predict_fn, proposals, batch_buffer):
+        """
+        Returns the predictions for the candidates of all the given proposals, in order. The candidates are copied
+        from the proposals straight into batch_buffer, which is passed to the model every time it is full, such that
+        a lock-step round never holds more than one batch of copied candidates however many attacks are running.
+        """
+        batch_size = len(batch_buffer)
+        predictions = []
+        batch_fill = 0
+        for _, candidates in proposals:
+            candidate_start = 0
+            while candidate_start < len(candidates):
+                copy_count = min(len(candidates) - candidate_start, batch_size - batch_fill)
+                candidate_end = candidate_start + copy_count
+                batch_buffer[batch_fill:batch_fill + copy_count] = candidates[candidate_start:candidate_end]
+                batch_fill += copy_count
+                candidate_start = candidate_end
+                if batch_fill == batch_size:
+                    predictions.append(predict_fn(batch_buffer))
+                    batch_fill = 0
+        if batch_fill > 0:
+            predictions.append(predict_fn(batch_buffer[:batch_fill]))
+        return np.concatenate(predictions, axis=0)
+
     def _compute_robustness_stats(self):
         if self._index_to_adversarial_strategy == {}:
             raise Exception(
@@ -130,26 +317,19 @@ class RobustnessCheck:
         adv_evo_strategy_indices = self.get_adversarial_strategy_indices()
 
         for i in adv_evo_strategy_indices:
-            img = self._index_to_adversarial_strategy[i].img
+            adversarial_strategy = self._index_to_adversarial_strategy[i]
+            img = adversarial_strategy.img
 
-            if self._index_to_adversarial_strategy[i].is_perturbed():
+            if adversarial_strategy.is_perturbed():
                 successful_perturbation_count += 1
-                successful_perturbation_queries.append(
-                    self._index_to_adversarial_strategy[i].queries
-                )
+                successful_perturbation_queries.append(adversarial_strategy.queries)
 
-                curr_l0 = image_distance(
-                    self._index_to_adversarial_strategy[i].get_best_candidate(),
-                    img,
-                    norm="L0",
-                )
+                best_candidate = adversarial_strategy.get_best_candidate()
+
+                curr_l0 = image_distance(best_candidate, img, norm="L0")
                 successful_perturbation_l0_distances.append(curr_l0)
 
-                curr_l2 = image_distance(
-                    self._index_to_adversarial_strategy[i].get_best_candidate(),
-                    img,
-                    norm="L2",
-                )
+                curr_l2 = image_distance(best_candidate, img, norm="L2")
                 successful_perturbation_l2_distances.append(curr_l2)
 
                 successful_perturbation_indices.append(i)
@@ -168,6 +348,12 @@ class RobustnessCheck:
             adv_evo_strategy_indices[0]
         ].pixel_space_max
 
+        # The per-image results are converted to arrays once, so downstream stats (means, medians, maxima) reduce over
+        # contiguous memory. They are kept as 64-bit types, such that the dumped JSON stats are unchanged.
+        successful_perturbation_queries = np.asarray(successful_perturbation_queries, dtype=np.int64)
+        successful_perturbation_l0_distances = np.asarray(successful_perturbation_l0_distances, dtype=np.int64)
+        successful_perturbation_l2_distances = np.asarray(successful_perturbation_l2_distances, dtype=np.float64)
+
         return {
             "count_succ": int(successful_perturbation_count),
             "queries_succ": successful_perturbation_queries,
@@ -206,6 +392,18 @@ class RobustnessCheck:
         adversarial_strategy = self._index_to_adversarial_strategy[index]
         return adversarial_strategy.get_best_candidate()
 
+    def get_adversarial_strategy_results(self):
+        """
+        Returns:
+            A list with one tuple (index, perturbed_flag, perturbed_image) per attacked image, equivalent to calling
+            get_adversarial_strategy_perturbed_flag and get_adversarial_strategy_perturbed_image for each index from
+            get_adversarial_strategy_indices, in the same order.
+        """
+        return [
+            (index, adversarial_strategy.is_perturbed(), adversarial_strategy.get_best_candidate())
+            for index, adversarial_strategy in self._index_to_adversarial_strategy.items()
+        ]
+
     def print_robustness_stats(self):
         """
         Prints the robustness check statistics in a human-readable format.
@@ -244,7 +442,44 @@ class RobustnessCheck:
         print(f"Median l0 dist: {np.median(l0_dists_succ)}")
 
         print()
-        print(f"Max query count: {max(queries_succ)}")
-        print(f"Max l0 dist: {max(l0_dists_succ)}")
+        print(f"Max query count: {queries_succ.max()}")
+        print(f"Max l0 dist: {l0_dists_succ.max()}")
         print(PRINT_SEPARATOR)
         print()
+
+
+def _run_one_attack(attack, model, attack_params, img, label, initial_proba):
+    attack_class = config.SUPPORTED_ATTACKS[attack]
+    adversarial_strategy = attack_class(
+        model=model,
+        img=img,
+        label=label,
+        initial_proba=initial_proba,
+        **attack_params,
+    )
+
+    no_steps = adversarial_strategy.run_adversarial_attack()
+
+    assert (
+        no_steps > 0
+    )  # This should hold as any correctly classified image requires at least one query
+
+    return adversarial_strategy
+
+
+def _init_attack_worker(model, attack, attack_params):
+    _worker_state["model"] = model
+    _worker_state["attack"] = attack
+    _worker_state["attack_params"] = attack_params
+
+
+def _run_one_attack_in_worker(attack_input):
+    img, label, initial_proba = attack_input
+    adversarial_strategy = _run_one_attack(
+        _worker_state["attack"], _worker_state["model"], _worker_state["attack_params"], img, label, initial_proba
+    )
+
+    # The model is not sent back to the main process, and predict_fn may be a closure that cannot be pickled
+    adversarial_strategy.model = None
+    adversarial_strategy.predict_fn = None
+    return adversarial_strategy
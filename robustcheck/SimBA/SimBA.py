@@ -1,5 +1,4 @@
 import numpy as np
-import random
 from robustcheck.types.UntargetedAttack import UntargetedAttack
 
 
@@ -15,9 +14,11 @@ class SimBA(UntargetedAttack):
     Attributes:
         model: Target model to be attacked. This has to expose a predict method that returns the
             output probability distributions when provided a batch of images as input.
-        img: An array (HxWxC) representing the target image to be perturbed.
+        img: An array (HxWxC) representing the target image to be perturbed. The attack perturbs a float32 copy of it.
         label: An integer representing the correct class index of the image.
         verbose: A boolean flag which, when set to True, enables printing info on the attack results.
+        initial_proba: Optional array of floats representing the model output for the unperturbed image, used instead
+            of querying the model for it (see UntargetedAttack).
 
     Methods:
         get_best_candidate(self): Returns the fittest individual in the active generation.
@@ -36,24 +37,100 @@ class SimBA(UntargetedAttack):
             pixel_space_min=0.0,
             pixel_space_max=1.0,
             steps=1000,
-            verbose=False
+            verbose=False,
+            initial_proba=None,
     ):
-        UntargetedAttack.__init__(self, model, img, label)  # Each instance encapsulates the model and image to perturb
-
-        self._perturbed_img = np.copy(img)  # self._perturbed_img is the variable we will iteratively perturb
-        self._model_perturbed_prediction = self.model.predict(np.array([self._perturbed_img]))[0]
+        # Each instance encapsulates the model and image to perturb
+        UntargetedAttack.__init__(self, model, img, label, initial_proba)
+
+        # self._perturbed_img is the variable we will iteratively perturb. It is kept in float32, which halves the
+        # memory traffic for float64 inputs, matches the input dtype of most models, and represents the fractional
+        # epsilon steps of integer images instead of truncating them.
+        self._perturbed_img = np.array(img, dtype=np.float32, order="C")
+        self._model_perturbed_prediction = self._get_initial_prediction()
+        # The predicted label is cached and only recomputed when the prediction of the perturbed image changes
+        self._perturbed_pred_label = int(np.argmax(self._model_perturbed_prediction))
         self.queries = 1
 
         self.epsilon = epsilon
 
-        self.pixel_space_min = pixel_space_min
-        self.pixel_space_max = pixel_space_max
+        # The bounds and the step size are kept in float32, like the perturbed image, such that clipping candidate
+        # values does not upcast them
+        self.pixel_space_min = np.float32(pixel_space_min)
+        self.pixel_space_max = np.float32(pixel_space_max)
+        self._delta = np.float32(epsilon * pixel_space_max)
 
         self.steps = steps
 
         self.verbose = verbose
 
-        self._unexplored_pixels = [(i, j) for i in range(np.shape(img)[0]) for j in range(np.shape(img)[1])]
+        # Pixels are explored uniformly at random without replacement, following a permutation drawn upfront. The
+        # pixel with flat index p is (p // width, p % width).
+        self._rng = np.random.default_rng()
+        self._pixel_order = self._rng.permutation(self._height * self._width).astype(np.int32)
+        self._next_pixel = 0
+
+        self._trial_index = 0
+        self._staged_pixel = None
+
+        # Both candidates of a step are written into this (2, H, W, C) buffer, whose rows are kept equal to
+        # self._perturbed_img between steps. Only the sampled pixel differs in a step, so no image copy is needed. It
+        # is allocated by the first propose_candidates call.
+        self._candidates_buffer = None
+
+    def propose_candidates(self):
+        """
+        Samples the next pixel to perturb and returns the batch of its two candidate images, perturbed by +epsilon and
+        -epsilon, or None if the attack has finished.
+        """
+        if self._trial_index >= self.steps or self.is_perturbed() or self._next_pixel >= self._pixel_order.size:
+            self._release_step_buffers()
+            return None
+
+        if self._candidates_buffer is None:
+            self._candidates_buffer = np.repeat(np.expand_dims(self._perturbed_img, axis=0), 2, axis=0)
+
+        sampled_pixel_x, sampled_pixel_y = divmod(int(self._pixel_order[self._next_pixel]), self._width)
+        self._next_pixel += 1
+
+        original_value = self._perturbed_img[sampled_pixel_x, sampled_pixel_y, 0]
+        candidates_pixel = self._candidates_buffer[:, sampled_pixel_x, sampled_pixel_y]
+        candidates_pixel[0, 0] = min(original_value + self._delta, self.pixel_space_max)
+        candidates_pixel[1, 0] = max(original_value - self._delta, self.pixel_space_min)
+        self._staged_pixel = (sampled_pixel_x, sampled_pixel_y)
+
+        # Both perturbation directions are evaluated in a single batched model query
+        return self._candidates_buffer
+
+    def receive_predictions(self, predictions):
+        """
+        Completes the attack step started by propose_candidates by keeping the perturbation direction that decreases
+        the probability of the correct class the most, if any decreases it.
+
+        Args:
+            predictions: An array of arrays of floats representing the probability distributions output by the target
+                model for the candidates returned by propose_candidates.
+        """
+        self._trial_index += 1
+        self.queries += len(predictions)
+
+        sampled_pixel_x, sampled_pixel_y = self._staged_pixel
+        best_candidate_index = np.argmin(predictions[:, self.label])
+        if predictions[best_candidate_index][self.label] < self._model_perturbed_prediction[self.label]:
+            self._model_perturbed_prediction = predictions[best_candidate_index]
+            self._perturbed_pred_label = int(np.argmax(self._model_perturbed_prediction))
+            self._perturbed_img[sampled_pixel_x, sampled_pixel_y, 0] = \
+                self._candidates_buffer[best_candidate_index, sampled_pixel_x, sampled_pixel_y, 0]
+
+        # Bring both rows of the candidates buffer back in sync with the perturbed image
+        self._candidates_buffer[:, sampled_pixel_x, sampled_pixel_y, 0] = \
+            self._perturbed_img[sampled_pixel_x, sampled_pixel_y, 0]
+        self._staged_pixel = None
+
+    def _release_step_buffers(self):
+        # Finished attacks are kept by RobustnessCheck, so the candidates buffer is freed. It is rebuilt on demand if
+        # the attack is stepped again.
+        self._candidates_buffer = None
 
     def run_adversarial_attack(self):
         """
@@ -63,49 +140,12 @@ class SimBA(UntargetedAttack):
              An integer representing the number of attack steps until either the attack was successful or the maximum
              steps threshold was reached.
         """
-        trial_index = 0
-        while trial_index < self.steps and not self.is_perturbed() and len(self._unexplored_pixels) > 0:
-            trial_index += 1
-
-            sampled_pixel_index = random.randint(0, len(self._unexplored_pixels) - 1)
-            (sampled_pixel_x, sampled_pixel_y) = self._unexplored_pixels[sampled_pixel_index]
-            self._unexplored_pixels.remove((sampled_pixel_x, sampled_pixel_y))
-
-            candidate_plus_perturbed_img = self._perturbed_img.copy()
-            candidate_plus_perturbed_img[sampled_pixel_x][sampled_pixel_y][0] += self.epsilon * self.pixel_space_max
-            candidate_plus_perturbed_img[sampled_pixel_x][sampled_pixel_y][0] = min(
-                candidate_plus_perturbed_img[sampled_pixel_x][sampled_pixel_y][0], self.pixel_space_max
-            )
-
-            candidate_plus_distribution = self.model.predict(np.array([candidate_plus_perturbed_img]))[0]
-            self.queries += 1
-
-            if candidate_plus_distribution[self.label] < self._model_perturbed_prediction[self.label]:
-                self._model_perturbed_prediction = candidate_plus_distribution
-                # l0_distance += 1
-                # l2_distance_sq += \
-                #     (img_pos[i][j][0] - img_clean[i][j][0]) ** 2 - (img[i][j][0] - img_clean[i][j][0]) ** 2
-                self._perturbed_img = candidate_plus_perturbed_img
-            else:
-                candidate_minus_perturbed_img = self._perturbed_img.copy()
-                candidate_minus_perturbed_img[sampled_pixel_x][sampled_pixel_y][0] -= \
-                    self.epsilon * self.pixel_space_max
-                candidate_minus_perturbed_img[sampled_pixel_x][sampled_pixel_y][0] = max(
-                    candidate_minus_perturbed_img[sampled_pixel_x][sampled_pixel_y][0], self.pixel_space_min
-                )
-
-                candidate_minus_distribution = self.model.predict(np.array([candidate_minus_perturbed_img]))[0]
-                self.queries += 1
-
-                if candidate_minus_distribution[self.label] < self._model_perturbed_prediction[self.label]:
-                    # curr_probs_distribution = res_neg_distribution
-                    # curr_prob = res_neg
-                    # l0_distance += 1
-                    # l2_distance_sq += \
-                    #     (img_neg[i][j][0] - img_clean[i][j][0]) ** 2 - (img[i][j][0] - img_clean[i][j][0]) ** 2
-                    # img = img_neg
-                    self._model_perturbed_prediction = candidate_minus_distribution
-                    self._perturbed_img = candidate_minus_perturbed_img
+        candidates = self.propose_candidates()
+        while candidates is not None:
+            self.receive_predictions(self.predict_fn(candidates))
+            candidates = self.propose_candidates()
+
+        trial_index = self._trial_index
 
         if self.is_perturbed() and self.verbose:
             print(f"Image successfully perturbed in {trial_index} rounds")
@@ -126,6 +166,4 @@ class SimBA(UntargetedAttack):
         Returns:
             A boolean representing whether the adversarial attack has been successful
         """
-        pred_label = np.argmax(self._model_perturbed_prediction)
-        correct_output = (pred_label == self.label)
-        return not correct_output
+        return self._perturbed_pred_label != self.label
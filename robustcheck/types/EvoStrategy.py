@@ -11,8 +11,8 @@ class EvoStrategy(ABC):
 
     Attributes:
         generation_count: An integer count of the generations created so far.
-        active_generation: A list of individuals of the same data type representing the
-            most recent generation created by the evolutionary search strategy.
+        active_generation: A list (or an array) of individuals of the same data type representing
+            the most recent generation created by the evolutionary search strategy.
         fitness_scores: A list of floats representing the fitness scores of each
             individual in the current active generation.
         queries: An integer representing all individuals explored so far by the
@@ -1,4 +1,6 @@
 from abc import ABC, abstractmethod
+import numpy as np
+from robustcheck.utils.model import get_predict_fn
 
 
 class UntargetedAttack(ABC):
@@ -11,18 +13,41 @@ class UntargetedAttack(ABC):
                 output probability distributions when provided a batch of images as input.
             img: An array (HxWxC) representing the target image to be perturbed.
             label: An integer representing the correct class index of the image.
+            predict_fn: The function used by the attack to query the model on a batch of images. This calls Keras models
+                directly rather than through their predict method, which has a high per-call overhead on small batches.
+            initial_proba: Optional array of floats representing the probability distribution output by the model for
+                the unperturbed image, if it is already known (e.g. from a batched prediction over the whole dataset).
+                It saves the attack from querying the model on the unperturbed image. This still counts as one query.
 
         Methods:
             run_adversarial_attack(self): Abstract method, its implementation will run the adversarial attack.
             is_perturbed(self): Abstract method, its method will return a boolean indicating whether a successful
                 untargeted adversarial perturbation was found.
+            propose_candidates(self): Abstract method, its implementation will return the batch of candidate images that
+                the next attack step needs to be evaluated by the model, or None once the attack has finished.
+            receive_predictions(self, predictions): Abstract method, its implementation will complete the attack step
+                started by propose_candidates given the model predictions for its candidates.
+
+        The step-wise interface of propose_candidates and receive_predictions allows attacks to be driven in lock-step
+        with other attacks, such that the candidates of many attacks are evaluated together in batched model calls.
 
         """
-    def __init__(self, model, img, label):
+    def __init__(self, model, img, label, initial_proba=None):
         """Inits UntargetedAttack with the target model, image to perturb, and the index of the correct image label"""
         self.model = model
         self.img = img
         self.label = label
+        self.initial_proba = initial_proba
+        self.predict_fn = get_predict_fn(model)
+
+        # Image dimensions are cached once, as the attacks need them at every step
+        self._height, self._width, self._channels = np.shape(img)
+
+    def _get_initial_prediction(self):
+        # Model output for the unperturbed image, reusing initial_proba when it was provided
+        if self.initial_proba is not None:
+            return np.asarray(self.initial_proba)
+        return self.predict_fn(np.expand_dims(self.img, axis=0))[0]
 
     @abstractmethod
     def run_adversarial_attack(self):
@@ -33,3 +58,13 @@ class UntargetedAttack(ABC):
     def is_perturbed(self):
         """The implementation of this method will return whether the adversarial attack has been successful"""
         pass
+
+    @abstractmethod
+    def propose_candidates(self):
+        """The implementation of this method will return the candidate images of the next attack step (or None)"""
+        pass
+
+    @abstractmethod
+    def receive_predictions(self, predictions):
+        """The implementation of this method will complete the attack step given the predictions of its candidates"""
+        pass
@@ -1 +1 @@
-from .utils import save_robustness_stats_artifacts, generate_mlflow_logs, PRINT_SEPARATOR
+from .utils import save_robustness_stats_artifacts, save_adversarial_images, generate_mlflow_logs, PRINT_SEPARATOR
@@ -1,5 +1,12 @@
+import math
+import threading
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:  # numba is an optional dependency: image_distance falls back to NumPy without it
+    njit = None
+
 
 def top_k_accuracy(y_true, y_pred, k=1):
     """From: https://github.com/chainer/chainer/issues/606
@@ -10,11 +17,68 @@ def top_k_accuracy(y_true, y_pred, k=1):
     return np.any(argsorted_y.T == y_true.argmax(axis=1), axis=0).mean()
 
 
+if njit is not None:
+    @njit(cache=True)
+    def _l0_distance(source_pixels, target_pixels):
+        distance = 0
+        for index in range(source_pixels.size):
+            if source_pixels[index] != target_pixels[index]:
+                distance += 1
+        return distance
+
+    @njit(fastmath=True, cache=True)
+    def _l2_distance(source_pixels, target_pixels):
+        squared_distance = 0.0
+        for index in range(source_pixels.size):
+            difference = source_pixels[index] - target_pixels[index]
+            squared_distance += difference * difference
+        return math.sqrt(squared_distance)
+
+
+def _use_compiled_distance(source_image, target_image, norm):
+    # The compiled kernels are only used where they match the NumPy semantics: images of the same shape and dtype, and
+    # floating point images for L2, as NumPy integer subtraction wraps around for unsigned and narrow integer types.
+    if njit is None or not isinstance(source_image, np.ndarray) or not isinstance(target_image, np.ndarray):
+        return False
+    if source_image.shape != target_image.shape or source_image.dtype != target_image.dtype:
+        return False
+    return norm == "L0" or source_image.dtype.kind == "f"
+
+
+# Difference buffer reused across image_distance calls, one per thread. Only the buffer of the last shape and dtype
+# is kept, such that a long-lived thread does not hold one buffer for every image shape it has seen.
+_scratch_buffers = threading.local()
+
+
+def _get_scratch(shape, dtype):
+    scratch = getattr(_scratch_buffers, "buffer", None)
+    if scratch is None or scratch.shape != shape or scratch.dtype != dtype:
+        scratch = np.empty(shape, dtype=dtype)
+        _scratch_buffers.buffer = scratch
+    return scratch
+
+
 def image_distance(source_image, target_image, norm="L0"):
-    if norm == "L0":
-        distance = np.sum(source_image != target_image)
+    if norm in ("L0", "L2") and _use_compiled_distance(source_image, target_image, norm):
+        # Per-call NumPy overhead dominates on small images, so the distances are computed by compiled kernels when
+        # numba is installed
+        kernel = _l0_distance if norm == "L0" else _l2_distance
+        distance = kernel(np.ravel(source_image), np.ravel(target_image))
+    elif norm == "L0":
+        distance = np.count_nonzero(source_image != target_image)
     elif norm == "L2":
-        distance = np.sqrt(np.sum((source_image - target_image) ** 2))
+        # The difference is written into a reusable contiguous buffer, whatever the strides of the inputs, and its
+        # squared norm is computed by a dot product. Integer images (e.g. uint8) are subtracted in float64, as integer
+        # subtraction and products wrap around in their own type.
+        source_image = np.asarray(source_image)
+        target_image = np.asarray(target_image)
+        difference_dtype = np.result_type(source_image, target_image)
+        if difference_dtype.kind != "f":
+            difference_dtype = np.dtype(np.float64)
+        difference = _get_scratch(np.broadcast(source_image, target_image).shape, difference_dtype)
+        np.subtract(source_image, target_image, out=difference, dtype=difference_dtype)
+        difference = difference.ravel()
+        distance = np.sqrt(np.dot(difference, difference))
     else:
         raise Exception(f"Norm {norm} is not supported")
 
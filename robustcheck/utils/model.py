@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def get_predict_fn(model):
+    """
+    Returns the function used to query the target model on a batch of images.
+
+    Keras models are called directly as model(batch, training=False), which skips the per-call orchestration overhead
+    of model.predict (data adapters, callbacks, progress logging). This overhead dominates for the small batches the
+    attacks evaluate at every step. Any other model is queried through its predict method.
+
+    Batches are passed to the model as C-contiguous arrays. For Keras models they are also cast to the dtype of the
+    model input, such that the framework does not make another copy to convert them before inference.
+
+    Arguments:
+        model: Target model exposing a predict method that returns the output probability distributions when provided
+            a batch of images as input.
+
+    Returns:
+        A function taking a batch of images and returning an array of probability distributions.
+    """
+    if is_keras_model(model):
+        input_dtype = _get_input_dtype(model)
+
+        def predict_fn(batch):
+            return np.asarray(model(np.ascontiguousarray(batch, dtype=input_dtype), training=False))
+
+        return predict_fn
+
+    def predict_fn(batch):
+        return model.predict(np.ascontiguousarray(batch))
+
+    return predict_fn
+
+
+def is_keras_model(model):
+    """
+    Returns a boolean representing whether model is a Keras model (from keras or tensorflow.keras).
+    """
+    # Checked by name to avoid importing tensorflow or keras, which are not dependencies of the package
+    for model_class in type(model).__mro__:
+        if model_class.__name__ == "Model" and model_class.__module__.split(".")[0] in ("keras", "tensorflow"):
+            return True
+    return False
+
+
+def _get_input_dtype(model):
+    # Keras 2 exposes the input dtype as a tf.DType, Keras 3 as a string. None keeps the dtype of the batch.
+    try:
+        input_dtype = model.inputs[0].dtype
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+    try:
+        return np.dtype(getattr(input_dtype, "as_numpy_dtype", input_dtype))
+    except TypeError:
+        return None
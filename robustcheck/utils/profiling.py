@@ -0,0 +1,144 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from robustcheck.utils.model import get_predict_fn
+
+DEFAULT_WARMUP_CALLS = 50
+DEFAULT_TIMED_CALLS = 200
+
+# Operations of the attacks that are instrumented by Profiler.instrument when present. The model queries (predict_fn)
+# are compute-bound on the model forward pass, while the others are bound by the Python interpreter and the memory
+# traffic of building candidate images. Comparing them shows which side dominates an attack step.
+DEFAULT_INSTRUMENTED_OPERATIONS = (
+    "predict_fn",
+    "select_group",
+    "update",
+    "propose_candidates",
+    "receive_predictions",
+    "_get_next_generation",
+)
+
+
+class Profiler:
+    """Lightweight wall clock profiler for the hot operations of the adversarial attacks.
+
+    The first warmup_calls calls of every operation are not recorded, such that one-off costs such as building or
+    tracing the model graph on the first calls do not skew the results. The durations of the following calls are kept
+    in a ring buffer of size timed_calls per operation, so a profiler can stay attached to a long running attack.
+
+    Attributes:
+        warmup_calls: An integer representing how many calls of each operation are run untimed before recording.
+        timed_calls: An integer representing how many of the most recent call durations are kept per operation.
+
+    Methods:
+        timed(self, name): Context manager recording the wall clock time of its body as one call of operation name.
+        wrap(self, name, function): Returns function wrapped such that each of its calls is recorded under name.
+        instrument(self, attack, operations=DEFAULT_INSTRUMENTED_OPERATIONS): Wraps the given operations of an attack
+            instance in place, such that running the attack records their timings.
+        summary(self): Returns a dictionary mapping each recorded operation to statistics of its call durations.
+    """
+    def __init__(self, warmup_calls=DEFAULT_WARMUP_CALLS, timed_calls=DEFAULT_TIMED_CALLS):
+        self.warmup_calls = warmup_calls
+        self.timed_calls = timed_calls
+        self._call_counts = {}
+        self._durations = {}
+
+    @contextmanager
+    def timed(self, name):
+        call_index = self._call_counts.get(name, 0)
+        self._call_counts[name] = call_index + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if call_index >= self.warmup_calls:
+                if name not in self._durations:
+                    self._durations[name] = deque(maxlen=self.timed_calls)
+                self._durations[name].append(time.perf_counter() - start)
+
+    def wrap(self, name, function):
+        def timed_function(*args, **kwargs):
+            with self.timed(name):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+    def instrument(self, attack, operations=DEFAULT_INSTRUMENTED_OPERATIONS):
+        # Instance attributes shadow the class methods, so the attack picks up the wrapped versions for all its calls
+        for name in operations:
+            if hasattr(attack, name):
+                setattr(attack, name, self.wrap(name, getattr(attack, name)))
+        return attack
+
+    def summary(self):
+        """
+        Returns:
+            A dictionary mapping the name of each operation with recorded calls to a dictionary with the number of
+            calls seen ("calls"), the number of timed calls kept ("timed_calls") and the mean, median and total
+            duration in seconds of the timed calls ("mean_s", "median_s", "total_s").
+        """
+        summary = {}
+        for name, durations in self._durations.items():
+            durations = np.asarray(durations)
+            summary[name] = {
+                "calls": self._call_counts[name],
+                "timed_calls": len(durations),
+                "mean_s": float(np.mean(durations)),
+                "median_s": float(np.median(durations)),
+                "total_s": float(np.sum(durations)),
+            }
+        return summary
+
+
+def tune_batch_size(
+    model,
+    img,
+    batch_sizes=(1, 2, 4, 8, 16, 32, 64),
+    warmup_calls=DEFAULT_WARMUP_CALLS,
+    timed_calls=DEFAULT_TIMED_CALLS,
+    tolerance=0.05,
+):
+    """
+    Finds the batch size from which querying the model on larger batches stops reducing the latency per image.
+
+    The model is queried on batches of copies of img of increasing size. The latency per image usually decreases with
+    the batch size while the per-call overhead of the model dominates, and flattens once the forward pass itself
+    dominates. The chosen batch size is a good value for the candidates_per_step parameter of EpsilonGreedyUntargeted
+    or the generation_size parameter of EvoStrategyUniformUntargeted.
+
+    Args:
+        model: Target model exposing a predict method that returns the output probability distributions when provided
+            a batch of images as input.
+        img: An array (HxWxC) representing an image from the dataset used for the robustness check.
+        batch_sizes: An increasing sequence of integers representing the batch sizes to try.
+        warmup_calls: An integer representing how many untimed model calls are made for each batch size.
+        timed_calls: An integer representing how many timed model calls are made for each batch size.
+        tolerance: A float representing the minimum relative decrease of the latency per image that a larger batch
+            size needs to bring to be chosen.
+
+    Returns:
+        A tuple (batch_size, latencies_per_image), where batch_size is the chosen batch size and latencies_per_image
+            is a dictionary mapping each tried batch size to the median model latency per image in seconds.
+    """
+    predict_fn = get_predict_fn(model)
+    profiler = Profiler(warmup_calls=warmup_calls, timed_calls=timed_calls)
+
+    best_batch_size = None
+    latencies_per_image = {}
+    for batch_size in batch_sizes:
+        batch = np.repeat(np.expand_dims(img, axis=0), batch_size, axis=0)
+        for _ in range(warmup_calls + timed_calls):
+            with profiler.timed(batch_size):
+                predict_fn(batch)
+
+        latencies_per_image[batch_size] = profiler.summary()[batch_size]["median_s"] / batch_size
+
+        if best_batch_size is not None and \
+                latencies_per_image[batch_size] > (1 - tolerance) * latencies_per_image[best_batch_size]:
+            break
+        best_batch_size = batch_size
+
+    return best_batch_size, latencies_per_image
@@ -1,14 +1,53 @@
-from matplotlib import pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import json
-import mlflow
+import math
 import os
+import tempfile
+import time
+
+# mlflow, matplotlib and Pillow are slow to import, so they are imported by the functions that use them rather than
+# here. This keeps importing robustcheck fast for users that never save plots or log to mlflow. Figures are created
+# through matplotlib.figure.Figure rather than pyplot, which avoids selecting and probing a GUI backend just to write
+# PNGs.
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional dependency: dumps_stats falls back to the json module without it
+    orjson = None
+
+try:
+    from pyspng import encode as png_encode
+except ImportError:  # pyspng-seunglab is an optional dependency: save_image falls back to Pillow without it
+    png_encode = None
 
 PRINT_SEPARATOR = "_" * 19
 
+# Types of the robustness stats that are logged as mlflow metrics
+NUMERIC_TYPES = (int, float, np.integer, np.floating)
+
+# Axes reused by save_histogram when it is not given any, created on first use
+_histogram_axes = None
+
+
+# Conversions of the NumPy types found in the robustness stats to JSON serializable values, looked up by exact type
+_NP_CONVERSIONS = {
+    **{
+        np_type: int
+        for np_type in (np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64)
+    },
+    **{np_type: float for np_type in (np.float16, np.float32, np.float64)},
+    np.ndarray: np.ndarray.tolist,
+}
+
 
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
+        # A single dictionary lookup covers the common types, while the isinstance checks below handle the others,
+        # such as subclasses and platform-specific types
+        conversion = _NP_CONVERSIONS.get(type(obj))
+        if conversion is not None:
+            return conversion(obj)
         if isinstance(obj, np.integer):
             return int(obj)
         if isinstance(obj, np.floating):
@@ -18,76 +57,228 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
 
 
-def save_histogram(values, fname, title, x_label="", y_label="", clf=True, fig_size=(20, 14), font_size=24):
-    fig = plt.figure(figsize=fig_size)
-    plt.title(title, fontdict={"size": font_size})
+def dumps_stats(stats):
+    """
+    Serializes a dictionary of robustness stats, which can contain NumPy scalars and arrays, to compact JSON bytes.
+    NumPy values are serialized natively by orjson when it is installed, and with the json module otherwise. Both give
+    the same JSON document: compact separators, and non-finite floats (e.g. the NaN mean of an empty list of
+    successful perturbations) written as null, as NaN is not valid JSON. Only the text formatting of some floats
+    differs (e.g. 1e-05 vs 0.00001), not their parsed values.
+    """
+    if orjson is not None:
+        # NpEncoder.default also handles the NumPy values that orjson does not serialize natively, such as
+        # non-contiguous arrays
+        return orjson.dumps(
+            stats, default=NpEncoder().default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        )
+    return json.dumps(
+        _replace_non_finite_floats(stats), cls=NpEncoder, separators=(",", ":"), allow_nan=False
+    ).encode("utf-8")
+
+
+def _replace_non_finite_floats(obj):
+    # Mirrors orjson, which writes NaN and infinite floats as null
+    if isinstance(obj, dict):
+        return {key: _replace_non_finite_floats(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_replace_non_finite_floats(value) for value in obj]
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind in "fc" and not np.all(np.isfinite(obj)):
+            return _replace_non_finite_floats(obj.tolist())
+        return obj
+    if isinstance(obj, (float, np.floating)) and not math.isfinite(obj):
+        return None
+    return obj
+
+
+def save_histogram(
+    values, fname, title, x_label="", y_label="", clf=True, fig_size=(20, 14), font_size=24, ax=None
+):
+    # When ax is given, the histogram is drawn on it (after clearing it), such that several histograms can be saved with
+    # a single figure. The caller owns that figure and is responsible for closing it. Otherwise, the histogram is drawn
+    # on a module-level figure that is shared by all such calls instead of allocating a new figure every time.
+    if ax is None:
+        ax = _get_histogram_axes()
+        ax.figure.set_size_inches(fig_size)
+    fig = ax.figure
+    ax.clear()
+
+    ax.set_title(title, fontdict={"size": font_size})
+
+    ax.set_xlabel(x_label, fontsize=font_size)
+    ax.set_ylabel(y_label, fontsize=font_size)
+
+    ax.tick_params(axis="both", labelsize=font_size)
+
+    # The histogram is binned upfront and drawn as bars, which skips the float64 conversion and per-bin patch
+    # construction done by ax.hist. Float values are binned in float32, while integer values (L0 distances, query
+    # counts) are binned as they are.
+    values = np.asarray(values)
+    if values.dtype == np.float64:
+        values = values.astype(np.float32)
+    counts, bin_edges = np.histogram(values, bins=min(50, max(10, int(np.sqrt(values.size)))))
+    ax.bar(bin_edges[:-1], counts, width=np.diff(bin_edges), align="edge")
+    # Fast PNG compression, and no bbox_inches="tight" which renders the figure a second time just to measure it
+    fig.savefig(fname, pil_kwargs={"compress_level": 1})
 
-    plt.xlabel(x_label, fontsize=font_size)
-    plt.ylabel(y_label, fontsize=font_size)
+    if clf:
+        ax.clear()
 
-    plt.xticks(fontsize=font_size)
-    plt.yticks(fontsize=font_size)
+    return fig
 
-    plt.hist(values)
-    plt.savefig(fname, bbox_inches="tight")
 
-    if clf:
-        plt.clf()
+def _get_histogram_axes():
+    global _histogram_axes
+    if _histogram_axes is None:
+        from matplotlib.figure import Figure
 
-    return fig
+        _histogram_axes = Figure().subplots()
+    return _histogram_axes
 
 
-def save_robustness_stats_artifacts(robustness_check, run_output_folder):
+def save_image(fname, img):
     """
-    Saves robustness check artifacts containings metrics and histograms of queries and perturbartion distances on the
-    local file system.
+    Saves an image (HxWxC, with 1, 3 or 4 channels and pixel values in [0, 255]) as a PNG file, using a fast
+    compression level. The image is encoded with the libspng-based pyspng when it is installed, and with Pillow
+    otherwise.
+    """
+    # uint8 images are encoded as they are, other images are clipped and cast to uint8 first
+    if np.asarray(img).dtype != np.uint8:
+        img = np.clip(img, 0, 255).astype(np.uint8)
+    img = np.ascontiguousarray(img)
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[:, :, 0]
 
-    Arguments:
-        robustness_check: RobustnessCheck containing the model and dataset to be benchmarked. This requires its
-            run_robustness_check() method to have been executed such that we have metrics to extract from it.
-        run_output_folder: A string representing where to save the arising artifacts.
+    if png_encode is not None:
+        with open(fname, "wb") as outfile:
+            outfile.write(png_encode(img, compress_level=1))
+    else:
+        # Pillow is installed as a dependency of matplotlib
+        from PIL import Image
+
+        Image.fromarray(img).save(fname, compress_level=1)
+
+
+def save_robustness_histograms(robustness_stats, output_folder):
     """
-    robustness_stats = robustness_check.get_stats()
+    Saves the histograms of the query counts and perturbation distances of the successful perturbations as PNG files.
 
-    with open(run_output_folder + "/robustness_stats.json", "w") as outfile:
-        json.dump(dict(robustness_stats), outfile, cls=NpEncoder)
+    Arguments:
+        robustness_stats: A dictionary of robustness stats, as returned by RobustnessCheck.get_stats().
+        output_folder: A string representing where to save the histograms.
+    """
+    from matplotlib.figure import Figure
 
-    l0_dists_succ = robustness_stats["l0_dists_succ"]
-    l2_dists_succ = robustness_stats["l0_dists_succ"]
-    queries_succ = robustness_stats["queries_succ"]
+    # A single figure is reused for all the histograms. It is created without pyplot, so it is not registered in
+    # pyplot's figure registry (and does not need to be closed) and it is always rendered with the headless Agg
+    # canvas, whatever the pyplot backend is.
+    ax = Figure(figsize=(20, 14)).subplots()
 
-    l0_dists_hist_fname = "l0_dists_histogram.png"
     _ = save_histogram(
-        values=l0_dists_succ,
-        fname=os.path.join(run_output_folder, l0_dists_hist_fname),
+        values=robustness_stats["l0_dists_succ"],
+        fname=os.path.join(output_folder, "l0_dists_histogram.png"),
         title="L0 distance distribution of successful perturbations",
         x_label="L0 distance",
         y_label="Image count",
         clf=False,
+        ax=ax,
     )
 
-    l2_dists_hist_fname = "l2_dists_histogram.png"
     _ = save_histogram(
-        values=l2_dists_succ,
-        fname=os.path.join(run_output_folder, l2_dists_hist_fname),
+        values=robustness_stats["l2_dists_succ"],
+        fname=os.path.join(output_folder, "l2_dists_histogram.png"),
         title="L2 distance distribution of successful perturbations",
         x_label="L2 distance",
         y_label="Image count",
         clf=False,
+        ax=ax,
     )
 
-    queries_hist_fname = "queries_histogram.png"
     _ = save_histogram(
-        values=queries_succ,
-        fname=os.path.join(run_output_folder, queries_hist_fname),
+        values=robustness_stats["queries_succ"],
+        fname=os.path.join(output_folder, "queries_histogram.png"),
         title="Query count distribution of successful perturbations",
         x_label="Query count",
         y_label="Image count",
         clf=False,
+        ax=ax,
     )
 
 
-def generate_mlflow_logs(robustness_check, run_name, experiment_name="default", tracking_uri="mlruns"):
+def save_robustness_stats_artifacts(robustness_check, run_output_folder, make_plots=True):
+    """
+    Saves robustness check artifacts containings metrics and histograms of queries and perturbartion distances on the
+    local file system.
+
+    Arguments:
+        robustness_check: RobustnessCheck containing the model and dataset to be benchmarked. This requires its
+            run_robustness_check() method to have been executed such that we have metrics to extract from it.
+        run_output_folder: A string representing where to save the arising artifacts.
+        make_plots: A boolean flag which, when set to False, skips rendering and saving the histograms and only saves
+            the metrics.
+    """
+    robustness_stats = robustness_check.get_stats()
+
+    with open(os.path.join(run_output_folder, "robustness_stats.json"), "wb") as outfile:
+        outfile.write(dumps_stats(robustness_stats))
+
+    if not make_plots:
+        return
+
+    save_robustness_histograms(robustness_stats, run_output_folder)
+
+
+def save_adversarial_images(robustness_check, output_folder, max_images=None):
+    """
+    Saves the perturbed and original version of the attacked images as PNG files named {index}_perturbed_succ.png (or
+    {index}_perturbed_fail.png for failed attacks) and {index}_original.png.
+
+    Arguments:
+        robustness_check: RobustnessCheck whose run_robustness_check() method has been executed.
+        output_folder: A string representing where to save the images.
+        max_images: An optional integer capping how many attacked images are saved. When set, a fixed random sample of
+            at most max_images attacked images is saved instead of all of them.
+    """
+    adversarial_strategy_results = robustness_check.get_adversarial_strategy_results()
+    if max_images is not None and len(adversarial_strategy_results) > max_images:
+        # The sample is drawn with a fixed seed, such that reruns save the same images, and kept in index order
+        sampled_positions = np.random.default_rng(0).choice(
+            len(adversarial_strategy_results), size=max_images, replace=False
+        )
+        adversarial_strategy_results = [
+            adversarial_strategy_results[position] for position in np.sort(sampled_positions)
+        ]
+    x_test = robustness_check.x_test
+
+    # The paths of the perturbed and original images are built upfront, such that the loop below only submits work
+    image_paths = [
+        (
+            os.path.join(output_folder, f"{i}_perturbed_{'succ' if perturbed_flag else 'fail'}.png"),
+            os.path.join(output_folder, f"{i}_original.png"),
+        )
+        for i, perturbed_flag, _ in adversarial_strategy_results
+    ]
+
+    # The images are encoded in parallel, as PNG compression releases the GIL
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        saved_images = []
+        for (i, _, perturbed_img), (perturbed_path, original_path) in zip(adversarial_strategy_results, image_paths):
+            saved_images.append(executor.submit(save_image, perturbed_path, perturbed_img))
+            saved_images.append(executor.submit(save_image, original_path, x_test[i]))
+
+        # Raise any error that occurred while saving an image
+        for saved_image in saved_images:
+            saved_image.result()
+
+
+def generate_mlflow_logs(
+    robustness_check,
+    run_name,
+    experiment_name="default",
+    tracking_uri="mlruns",
+    make_plots=True,
+    max_image_artifacts=None,
+):
     """
     Generates robustness check logs on mlflow.
 
@@ -98,77 +289,39 @@ def generate_mlflow_logs(robustness_check, run_name, experiment_name="default",
         experiment_name: A string representing the experiment name under which the mlflow artifacts and metrics will be
             logged.
         tracking_uri: A string representing the path where the mlflow artifacts and metrics will be stored.
+        make_plots: A boolean flag which, when set to False, skips rendering and logging the histograms.
+        max_image_artifacts: An optional integer capping how many attacked images have their perturbed and original
+            versions logged (see save_adversarial_images). Uploading two images per attacked image dominates the
+            logging time on large datasets. Setting it to 0 skips logging images. The metrics and histograms always
+            cover all the attacked images.
     """
+    import mlflow
+    from mlflow.entities import Metric
+    from mlflow.tracking import MlflowClient
+
     mlflow.set_tracking_uri(tracking_uri)
     mlflow.set_experiment(experiment_name)
-    mlflow.start_run(run_name=run_name)
+    run = mlflow.start_run(run_name=run_name)
 
     robustness_stats = robustness_check.get_stats()
 
-    for metric in robustness_stats:
-        metric_value = robustness_stats[metric]
-        # Only log non-array and non-list stats, as robustness_metrics can also contain lists or arrays that are not
-        #  supported by mlflow.log_metric
-        if type(metric_value) not in [list, np.array]:
-            mlflow.log_metric(metric, robustness_stats[metric])
-
-    l0_dists_succ = robustness_stats["l0_dists_succ"]
-    l2_dists_succ = robustness_stats["l0_dists_succ"]
-    queries_succ = robustness_stats["queries_succ"]
-
-    l0_dists_hist_fname = "l0_dists_histogram.png"
-    _ = save_histogram(
-        values=l0_dists_succ,
-        fname=l0_dists_hist_fname,
-        title="L0 distance distribution of successful perturbations",
-        x_label="L0 distance",
-        y_label="Image count",
-        clf=True,
-    )
-    mlflow.log_artifact(l0_dists_hist_fname)
-    os.remove(l0_dists_hist_fname)
-
-    l2_dists_hist_fname = "l2_dists_histogram.png"
-    _ = save_histogram(
-        values=l2_dists_succ,
-        fname=l2_dists_hist_fname,
-        title="L2 distance distribution of successful perturbations",
-        x_label="L2 distance",
-        y_label="Image count",
-        clf=True,
-    )
-    mlflow.log_artifact(l2_dists_hist_fname)
-    os.remove(l2_dists_hist_fname)
-
-    queries_hist_fname = "queries_histogram.png"
-    _ = save_histogram(
-        values=queries_succ,
-        fname=queries_hist_fname,
-        title="Query counts of successful perturbations",
-        x_label="Queries",
-        y_label="Image count",
-        clf=True,
-    )
-    mlflow.log_artifact(queries_hist_fname)
-    os.remove(queries_hist_fname)
-
-    adversarial_strategy_indices = robustness_check.get_adversarial_strategy_indices()
-
-    for i in adversarial_strategy_indices:
-        if robustness_check.get_adversarial_strategy_perturbed_flag(i):
-            fname = f"{i}_perturbed_succ.png"
-        else:
-            fname = f"{i}_perturbed_fail.png"
+    # Only log numeric scalar stats, as robustness_metrics also contains lists and arrays that are not supported as
+    # mlflow metrics. All the metrics are sent in a single batched request.
+    timestamp = int(time.time() * 1000)
+    metrics = [
+        Metric(metric, float(metric_value), timestamp, 0)
+        for metric, metric_value in robustness_stats.items()
+        if isinstance(metric_value, NUMERIC_TYPES)
+    ]
+    MlflowClient().log_batch(run.info.run_id, metrics=metrics)
 
-        perturbed_img = robustness_check.get_adversarial_strategy_perturbed_image(i)
+    # All the artifacts are written to a temporary folder and logged to mlflow in a single call
+    with tempfile.TemporaryDirectory() as artifacts_folder:
+        if make_plots:
+            save_robustness_histograms(robustness_stats, artifacts_folder)
 
-        plt.imsave(fname, perturbed_img / 255)
-        mlflow.log_artifact(fname)
-        os.remove(fname)
+        save_adversarial_images(robustness_check, artifacts_folder, max_images=max_image_artifacts)
 
-        fname = f"{i}_original.png"
-        plt.imsave(fname, robustness_check.x_test[i] / 255)
-        mlflow.log_artifact(fname)
-        os.remove(fname)
+        mlflow.log_artifacts(artifacts_folder)
 
     mlflow.end_run()
@@ -18,4 +18,9 @@ setup(
     include_package_data=True,
     python_requires=">=3.8.0",
     install_requires=requirements,
+    extras_require={
+        "numba": ["numba >= 0.50.0"],
+        "pyspng": ["pyspng-seunglab"],
+        "orjson": ["orjson >= 3.0.0"],
+    },
 )
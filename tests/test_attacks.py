@@ -0,0 +1,397 @@
+import numpy as np
+import pytest
+from robustcheck import EvoStrategyUniformUntargeted, EpsilonGreedyUntargeted, RobustnessCheck
+from robustcheck.SimBA import SimBA
+from robustcheck.types.AttackType import AttackType
+from robustcheck.EpsilonGreedyUntargeted.EpsilonGreedyUntargeted import SELECTION_SCHEDULE_BLOCK_SIZE
+from robustcheck.EpsilonGreedyUntargeted.utils import (
+    get_grid_pixel_groups,
+    get_grid_pixel_groups_array,
+    pixel_groups_to_array,
+)
+from robustcheck.utils.profiling import Profiler, tune_batch_size
+
+
+class LinearSoftmaxModel:
+    """Small deterministic classifier used to exercise the attacks without loading a deep learning model.
+
+    It also records how many times predict was called, how many images it was queried on in total and the size of the
+    largest batch it was queried on.
+    """
+    def __init__(self, image_shape=(8, 8, 3), num_classes=5, seed=0):
+        rng = np.random.RandomState(seed)
+        self.weights = rng.randn(int(np.prod(image_shape)), num_classes) / 40.0
+        self.predict_calls = 0
+        self.predicted_images = 0
+        self.largest_batch = 0
+
+    def predict(self, x, verbose=False):
+        self.predict_calls += 1
+        self.predicted_images += len(x)
+        self.largest_batch = max(self.largest_batch, len(x))
+        logits = np.asarray(x, dtype=np.float64).reshape(len(x), -1) @ self.weights
+        logits -= logits.max(axis=1, keepdims=True)
+        exp_logits = np.exp(logits)
+        return exp_logits / exp_logits.sum(axis=1, keepdims=True)
+
+
+class KerasLikeModel(LinearSoftmaxModel):
+    """LinearSoftmaxModel that is detected as a Keras model, recording the keyword arguments of its predict calls."""
+    def __init__(self, *args, **kwargs):
+        LinearSoftmaxModel.__init__(self, *args, **kwargs)
+        self.predict_kwargs = []
+
+    def predict(self, x, **kwargs):
+        self.predict_kwargs.append(kwargs)
+        return LinearSoftmaxModel.predict(self, x)
+
+    def __call__(self, x, training=False):
+        return LinearSoftmaxModel.predict(self, x)
+
+
+# Keras models are recognised by the name and module of a class in their MRO
+KerasLikeModel = type("Model", (KerasLikeModel,), {"__module__": "keras.models"})
+
+
+def get_sample(model, count=4, seed=1):
+    x = np.random.RandomState(seed).randint(0, 256, (count, 8, 8, 3))
+    y = np.argmax(model.predict(x), axis=1)
+    model.predict_calls = 0
+    model.predicted_images = 0
+    return x, y
+
+
+def test_evoba_queries_model_once_per_generation():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model)
+
+    attack = EvoStrategyUniformUntargeted(
+        model=model,
+        img=x[0],
+        label=y[0],
+        generation_size=10,
+        one_step_perturbation_pixel_count=2,
+        pixel_space_int_flag=True,
+        pixel_space_min=0,
+        pixel_space_max=255,
+    )
+    generations = attack.run_adversarial_attack()
+
+    # One batched call for the unperturbed image and one per generation, with no extra is_perturbed queries
+    assert model.predict_calls == 1 + generations
+    assert model.predicted_images == attack.queries
+    assert attack.is_perturbed() == (np.argmax(model.predict(attack.get_best_candidate()[np.newaxis])) != y[0])
+
+
+def test_epsilon_greedy_selection_schedule_is_drawn_in_blocks_and_released():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model)
+
+    attack = EpsilonGreedyUntargeted(
+        model=model,
+        img=x[0],
+        label=y[0],
+        pixel_groups=get_grid_pixel_groups((2, 2), (8, 8)),
+        steps=1000,
+        candidates_per_step=4,
+    )
+    assert len(attack._explore_schedule) == SELECTION_SCHEDULE_BLOCK_SIZE
+
+    attack.run_adversarial_attack()
+
+    assert attack._explore_schedule == [] and attack._candidates_buffer is None
+
+
+@pytest.mark.parametrize("batch_attacks", [False, True])
+def test_robustness_check_shares_one_pixel_groups_array_across_attacks(batch_attacks):
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model, count=6)
+    pixel_groups = get_grid_pixel_groups((2, 2), (8, 8))
+
+    rc = RobustnessCheck(
+        model=model,
+        x_test=x,
+        y_test=y,
+        attack=AttackType.EPSGREEDY,
+        attack_params={"pixel_groups": pixel_groups, "steps": 20},
+        batch_attacks=batch_attacks,
+    )
+    rc.run_robustness_check()
+
+    assert rc.attack_params["pixel_groups"] is pixel_groups
+    attacks = [rc._index_to_adversarial_strategy[index] for index in rc.get_adversarial_strategy_indices()]
+    assert all(attack.pixel_groups is attacks[0].pixel_groups for attack in attacks)
+    assert all(attack._pixel_groups_array is None for attack in attacks)
+
+    # The released array is loaded again if a finished attack is explored further
+    assert len(attacks[0].explore_attack_groups([0, 1])["potential_rewards"]) == 2
+
+
+def test_simba_step_keeps_the_lower_confidence_direction_within_bounds():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model)
+
+    # A large epsilon makes most candidate values fall outside the pixel space and get clipped
+    attack = SimBA(model=model, img=x[0] / 255, label=y[0], epsilon=0.6, steps=30)
+    kept_steps = 0
+    candidates = attack.propose_candidates()
+    while candidates is not None:
+        perturbed_img = attack.get_best_candidate().copy()
+        label_prob = model.predict(perturbed_img[np.newaxis])[0][y[0]]
+        queries = attack.queries
+
+        # Only the sampled pixel differs from the perturbed image, by +epsilon and -epsilon clipped to the pixel space
+        pixel = attack._staged_pixel + (0,)
+        expected_candidates = np.repeat(perturbed_img[np.newaxis], 2, axis=0)
+        expected_candidates[0][pixel] = min(perturbed_img[pixel] + np.float32(0.6), 1.0)
+        expected_candidates[1][pixel] = max(perturbed_img[pixel] - np.float32(0.6), 0.0)
+        np.testing.assert_array_equal(candidates, expected_candidates)
+        assert candidates.min() >= attack.pixel_space_min and candidates.max() <= attack.pixel_space_max
+
+        predictions = model.predict(candidates)
+        attack.receive_predictions(predictions)
+
+        assert attack.queries == queries + 2
+        lower_confidence_index = np.argmin(predictions[:, y[0]])
+        if predictions[lower_confidence_index][y[0]] < label_prob:
+            kept_steps += 1
+            np.testing.assert_array_equal(attack.get_best_candidate(), expected_candidates[lower_confidence_index])
+        else:
+            np.testing.assert_array_equal(attack.get_best_candidate(), perturbed_img)
+        candidates = attack.propose_candidates()
+
+    assert kept_steps > 0
+
+
+def test_simba_candidates_buffer_is_released_when_the_attack_finishes():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model)
+
+    attack = SimBA(model=model, img=x[0], label=y[0], epsilon=0.5, pixel_space_max=255, steps=20)
+    assert attack.propose_candidates().shape == (2, 8, 8, 3)
+    attack.receive_predictions(model.predict(attack._candidates_buffer))
+
+    attack.run_adversarial_attack()
+
+    assert attack.propose_candidates() is None and attack._candidates_buffer is None
+
+
+def test_epsilon_greedy_explore_attack_group_returns_the_altered_image():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model)
+
+    attack = EpsilonGreedyUntargeted(
+        model=model, img=x[0], label=y[0], pixel_groups=get_grid_pixel_groups((2, 2), (8, 8))
+    )
+    attack_result = attack.explore_attack_group(1)
+
+    altered_image_pred = model.predict(attack_result["altered_image"][np.newaxis])[0]
+    np.testing.assert_allclose(altered_image_pred, attack_result["pred_after"])
+    assert np.array_equal(attack.get_best_candidate(), x[0])
+    assert "altered_image" not in attack.explore_attack_group(1, return_altered_image=False)
+
+
+def test_epsilon_greedy_max_groups_track_the_argmax_ties():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model)
+
+    attack = EpsilonGreedyUntargeted(
+        model=model, img=x[0], label=y[0], pixel_groups=get_grid_pixel_groups((2, 2), (8, 8))
+    )
+    rng = np.random.RandomState(0)
+    for _ in range(2000):
+        # Few distinct rewards create ties, and negative rewards make groups drop below the highest value
+        attack.update(rng.randint(attack.number_groups), rng.choice([-1.0, 0.0, 0.5, 1.0]))
+
+        expected_max_groups = np.flatnonzero(attack._values == attack._values.max()).tolist()
+        assert sorted(attack._max_groups) == expected_max_groups
+        assert attack._max_value == attack._values.max()
+        assert all(attack._max_groups[position] == group for group, position in attack._max_group_positions.items())
+        assert len(attack._max_group_positions) == len(attack._max_groups)
+
+
+@pytest.mark.parametrize(
+    "patch_size, image_size", [((2, 2), (8, 8)), ((3, 2), (8, 7)), ((4, 5), (4, 5)), ((5, 5), (3, 4))]
+)
+def test_pixel_groups_array_matches_the_list_representation(patch_size, image_size):
+    pixel_groups = get_grid_pixel_groups(patch_size, image_size)
+
+    for pixel_groups_array, group_sizes in (
+        get_grid_pixel_groups_array(patch_size, image_size),
+        pixel_groups_to_array(pixel_groups),
+    ):
+        assert len(group_sizes) == len(pixel_groups)
+        for group_index, group in enumerate(pixel_groups):
+            assert group_sizes[group_index] == len(group)
+            np.testing.assert_array_equal(pixel_groups_array[group_index, :len(group)], group)
+
+
+def test_robustness_check_reuses_clean_predictions():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model)
+
+    rc = RobustnessCheck(
+        model=model,
+        x_test=x,
+        y_test=y,
+        attack=AttackType.EVOBA,
+        attack_params={"generation_size": 10, "one_step_perturbation_pixel_count": 2, "pixel_space_int_flag": True},
+    )
+    model.predict_calls = 0
+    rc.run_robustness_check()
+
+    # The attacks only query the model for their generations, the clean images were predicted in the constructor
+    generations = [rc._index_to_adversarial_strategy[index].generation_count for index in range(len(x))]
+    assert model.predict_calls == sum(generations)
+
+
+def test_keras_accuracy_evaluation_uses_a_single_predict_call():
+    model = KerasLikeModel()
+    x, y = get_sample(model, count=10)
+    model.predict_kwargs = []
+
+    RobustnessCheck(
+        model=model,
+        x_test=x,
+        y_test=y,
+        attack=AttackType.EVOBA,
+        attack_params={"generation_size": 10, "one_step_perturbation_pixel_count": 2, "pixel_space_int_flag": True},
+        predict_batch_size=4,
+    )
+
+    assert model.predict_kwargs == [{"batch_size": 4, "verbose": 0}]
+
+
+@pytest.mark.parametrize(
+    "attack, attack_params",
+    [
+        (AttackType.EPSGREEDY, {"pixel_groups": get_grid_pixel_groups((2, 2), (8, 8)), "steps": 50}),
+        (AttackType.SIMBA, {"epsilon": 0.5, "pixel_space_max": 255, "steps": 50}),
+    ],
+)
+def test_batched_attacks_share_model_calls(attack, attack_params):
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model, count=6)
+
+    rc = RobustnessCheck(
+        model=model,
+        x_test=x,
+        y_test=y,
+        attack=attack,
+        attack_params=attack_params,
+        batch_attacks=True,
+    )
+    model.predict_calls = 0
+    rc.run_robustness_check()
+
+    # Each lock-step round evaluates the candidates of all the running attacks together
+    assert model.predict_calls <= 6 + 50
+    for index in rc.get_adversarial_strategy_indices():
+        perturbed_img = rc.get_adversarial_strategy_perturbed_image(index)
+        predicted_label = np.argmax(model.predict(perturbed_img[np.newaxis]))
+        assert rc.get_adversarial_strategy_perturbed_flag(index) == (predicted_label != y[index])
+
+
+def test_batched_attacks_split_rounds_by_predict_batch_size():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model, count=6)
+
+    rc = RobustnessCheck(
+        model=model,
+        x_test=x,
+        y_test=y,
+        attack=AttackType.SIMBA,
+        attack_params={"epsilon": 0.5, "pixel_space_max": 255, "steps": 50},
+        batch_attacks=True,
+        predict_batch_size=5,
+    )
+    model.largest_batch = 0
+    rc.run_robustness_check()
+
+    # Rounds evaluate up to 12 candidates (2 per running attack), which are passed to the model in batches of 5
+    assert model.largest_batch == 5
+    assert len(rc.get_adversarial_strategy_indices()) == len(x)
+
+
+def test_batched_attacks_never_query_more_than_predict_batch_size_rows(monkeypatch):
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model, count=6)
+    predicted_batch_sizes = []
+
+    def get_recording_predict_fn(model):
+        def predict_fn(batch):
+            predicted_batch_sizes.append(len(batch))
+            return model.predict(batch)
+        return predict_fn
+
+    monkeypatch.setattr("robustcheck.types.UntargetedAttack.get_predict_fn", get_recording_predict_fn)
+    rc = RobustnessCheck(
+        model=model,
+        x_test=x,
+        y_test=y,
+        attack=AttackType.EPSGREEDY,
+        attack_params={"pixel_groups": get_grid_pixel_groups((2, 2), (8, 8)), "steps": 20, "candidates_per_step": 3},
+        batch_attacks=True,
+        predict_batch_size=4,
+    )
+    rc.run_robustness_check()
+
+    # The first round has 18 candidates, whose batches of 4 straddle the candidates of consecutive attacks
+    assert predicted_batch_sizes[:5] == [4, 4, 4, 4, 2]
+    assert max(predicted_batch_sizes) == 4
+    attacks = [rc._index_to_adversarial_strategy[index] for index in rc.get_adversarial_strategy_indices()]
+    assert sum(predicted_batch_sizes) == sum(attack.queries - 1 for attack in attacks)
+    for attack in attacks:
+        predicted_label = np.argmax(model.predict(attack.get_best_candidate()[np.newaxis]))
+        assert attack.is_perturbed() == (predicted_label != attack.label)
+
+
+@pytest.mark.parametrize("worker_type", ["thread", "process"])
+def test_concurrent_attacks_cover_correctly_classified_images(worker_type):
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model, count=6)
+    y[0] = (y[0] + 1) % 5
+
+    rc = RobustnessCheck(
+        model=model,
+        x_test=x,
+        y_test=y,
+        attack=AttackType.EPSGREEDY,
+        attack_params={"pixel_groups": get_grid_pixel_groups((2, 2), (8, 8)), "steps": 50},
+        n_workers=3,
+        worker_type=worker_type,
+    )
+    stats = rc.run_robustness_check()
+
+    assert rc.get_adversarial_strategy_indices() == [1, 2, 3, 4, 5]
+    assert stats["count_succ"] + stats["count_fail"] == 5
+
+
+def test_profiler_records_attack_operations_after_warmup():
+    model = LinearSoftmaxModel()
+    x, y = get_sample(model)
+
+    attack = EpsilonGreedyUntargeted(
+        model=model, img=x[0], label=y[0], pixel_groups=get_grid_pixel_groups((2, 2), (8, 8)), steps=30, epsilon=0.0
+    )
+    profiler = Profiler(warmup_calls=5, timed_calls=10)
+    profiler.instrument(attack)
+    steps = attack.run_adversarial_attack()
+
+    # The unperturbed image is queried in the constructor, before the attack is instrumented
+    summary = profiler.summary()
+    assert summary["predict_fn"]["calls"] == model.predict_calls - 1
+    assert summary["select_group"]["calls"] == steps
+    assert summary["select_group"]["timed_calls"] == min(10, steps - 5)
+
+
+def test_tune_batch_size_returns_a_tried_batch_size():
+    model = LinearSoftmaxModel()
+    x, _ = get_sample(model)
+
+    batch_size, latencies_per_image = tune_batch_size(
+        model, x[0], batch_sizes=(1, 4, 16), warmup_calls=2, timed_calls=5
+    )
+
+    assert batch_size in latencies_per_image
+    assert set(latencies_per_image) <= {1, 4, 16}
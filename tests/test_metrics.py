@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from robustcheck.utils import metrics
+from robustcheck.utils.metrics import image_distance
+
+
+def get_image_pair(dtype, seed=0):
+    rng = np.random.RandomState(seed)
+    source_image = rng.randint(0, 256, (16, 16, 3)).astype(dtype)
+    target_image = rng.randint(0, 256, (16, 16, 3)).astype(dtype)
+    return source_image, target_image
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int64, np.float32])
+def test_l2_distance_matches_float64_reference(dtype):
+    source_image, target_image = get_image_pair(dtype)
+
+    reference = np.linalg.norm(source_image.astype(np.float64) - target_image.astype(np.float64))
+
+    # uint8 differences wrap around when computed in the image dtype, which would give a different distance
+    assert image_distance(source_image, target_image, norm="L2") == pytest.approx(reference, rel=1e-6)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int64, np.float32])
+def test_l0_distance_matches_float64_reference(dtype):
+    source_image, target_image = get_image_pair(dtype)
+    target_image[:8] = source_image[:8]
+
+    reference = np.count_nonzero(source_image.astype(np.float64) != target_image.astype(np.float64))
+
+    assert image_distance(source_image, target_image, norm="L0") == reference
+
+
+def test_l2_distance_of_non_contiguous_images():
+    source_image, target_image = get_image_pair(np.uint8)
+    source_view, target_view = source_image[::2, ::-1], target_image[::2, ::-1]
+
+    reference = np.linalg.norm(source_view.astype(np.float64) - target_view.astype(np.float64))
+
+    assert image_distance(source_view, target_view, norm="L2") == pytest.approx(reference)
+
+
+def test_l2_distance_keeps_one_scratch_buffer_per_thread():
+    rng = np.random.RandomState(0)
+    for shape in [(16, 16, 3), (8, 8, 3), (8, 8, 1)]:
+        source_image = rng.rand(*shape).astype(np.float32)
+        # The target image broadcasts over the channels of the source image
+        target_image = rng.rand(shape[0], shape[1], 1).astype(np.float32)
+
+        reference = np.linalg.norm(source_image.astype(np.float64) - target_image.astype(np.float64))
+
+        assert image_distance(source_image, target_image, norm="L2") == pytest.approx(reference, rel=1e-6)
+        assert metrics._scratch_buffers.buffer.shape == shape
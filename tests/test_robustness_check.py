@@ -16,13 +16,12 @@ def test_robustness_check():
     x_test = np.load(os.path.join(os.path.dirname(__file__), "resources", "data", "cifar100_sample_x.npy"))
     y_test = np.load(os.path.join(os.path.dirname(__file__), "resources", "data", "cifar100_sample_y.npy"))
 
-    x_test = x_test.astype('float32')
-    x_test = x_test.astype('int')
+    x_test = x_test.astype('uint8')
 
-    preds = model.predict(x_test)
+    pred_labels = np.argmax(model.predict(x_test), axis=1)
     true_labels = np.argmax(y_test, axis=1)
 
-    correct_count = np.sum(true_labels == np.argmax(preds, axis=1))
+    correct_count = int(np.count_nonzero(true_labels == pred_labels))
 
     rc = RobustnessCheck(
         model=model,
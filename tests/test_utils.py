@@ -0,0 +1,192 @@
+import json
+
+import numpy as np
+import pytest
+from robustcheck.utils import utils
+
+
+class FinishedRobustnessCheck:
+    """Stands in for a RobustnessCheck whose run_robustness_check() has completed on 5 images, 3 of them attacked."""
+    def __init__(self):
+        rng = np.random.RandomState(0)
+        self.x_test = rng.randint(0, 256, (5, 8, 8, 3)).astype(np.uint8)
+        self._results = [
+            (index, perturbed_flag, np.clip(self.x_test[index] + rng.randn(8, 8, 3) * 20, 0, 255))
+            for index, perturbed_flag in [(0, True), (2, False), (3, True)]
+        ]
+
+    def get_stats(self):
+        return {
+            "count_succ": 2,
+            "queries_succ": np.array([11, 31], dtype=np.int64),
+            "l0_dists_succ": np.array([3, 7], dtype=np.int64),
+            "l2_dists_succ": np.array([40.5, 91.0]),
+            "indices_succ": [0, 3],
+            "count_fail": 1,
+            "indices_fail": [2],
+            "adversarial_accuracy": 0.2,
+            "queries_succ_mean": np.float64(21.0),
+            "l0_dists_succ_mean": np.float64(5.0),
+            "l2_dists_succ_mean": np.float64(0.26),
+            "l2_dists_succ_mean_pp": np.float64(0.001),
+        }
+
+    def get_adversarial_strategy_results(self):
+        return list(self._results)
+
+
+def get_stats():
+    return {
+        "count_succ": 2,
+        "queries_succ": np.array([11, 31], dtype=np.int64),
+        "l2_dists_succ": np.array([1.5, np.nan])[::-1],
+        "indices_succ": [np.int64(0), 3],
+        "adversarial_accuracy": 0.25,
+        "queries_succ_mean": np.float64(21.0),
+        "l2_dists_succ_mean": np.float64("nan"),
+        "l2_dists_succ_mean_pp": np.float32("inf"),
+    }
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_stats_writes_compact_json_with_null_for_non_finite_floats(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(utils, "orjson", None)
+
+    dumped_stats = utils.dumps_stats(get_stats())
+
+    assert b", " not in dumped_stats and b": " not in dumped_stats
+    assert json.loads(dumped_stats) == {
+        "count_succ": 2,
+        "queries_succ": [11, 31],
+        "l2_dists_succ": [None, 1.5],
+        "indices_succ": [0, 3],
+        "adversarial_accuracy": 0.25,
+        "queries_succ_mean": 21.0,
+        "l2_dists_succ_mean": None,
+        "l2_dists_succ_mean_pp": None,
+    }
+
+
+def test_dumps_stats_gives_the_same_bytes_with_and_without_orjson(monkeypatch):
+    pytest.importorskip("orjson")
+    stats = get_stats()
+
+    orjson_dumped_stats = utils.dumps_stats(stats)
+    monkeypatch.setattr(utils, "orjson", None)
+
+    assert utils.dumps_stats(stats) == orjson_dumped_stats
+
+
+HISTOGRAM_ARTIFACTS = {"l0_dists_histogram.png", "l2_dists_histogram.png", "queries_histogram.png"}
+IMAGE_ARTIFACTS = {
+    "0_perturbed_succ.png", "0_original.png", "2_perturbed_fail.png", "2_original.png", "3_perturbed_succ.png",
+    "3_original.png",
+}
+
+
+@pytest.mark.parametrize("make_plots, max_image_artifacts", [(True, None), (False, None), (True, 1), (False, 0)])
+def test_generate_mlflow_logs_logs_the_baseline_metrics_and_artifacts(
+    tmp_path, monkeypatch, make_plots, max_image_artifacts
+):
+    pytest.importorskip("mlflow")
+    from mlflow.tracking import MlflowClient
+
+    # The default artifact location of the sqlite backend is relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    tracking_uri = f"sqlite:///{tmp_path / 'mlflow.db'}"
+
+    utils.generate_mlflow_logs(
+        FinishedRobustnessCheck(),
+        run_name="test_run",
+        experiment_name="test_experiment",
+        tracking_uri=tracking_uri,
+        make_plots=make_plots,
+        max_image_artifacts=max_image_artifacts,
+    )
+
+    client = MlflowClient(tracking_uri)
+    (run,) = client.search_runs([client.get_experiment_by_name("test_experiment").experiment_id])
+    assert run.info.run_name == "test_run" and run.info.status == "FINISHED"
+    assert run.data.metrics == {
+        "count_succ": 2.0,
+        "count_fail": 1.0,
+        "adversarial_accuracy": 0.2,
+        "queries_succ_mean": 21.0,
+        "l0_dists_succ_mean": 5.0,
+        "l2_dists_succ_mean": 0.26,
+        "l2_dists_succ_mean_pp": 0.001,
+    }
+    assert run.data.params == {}
+
+    artifacts = {artifact.path for artifact in client.list_artifacts(run.info.run_id)}
+    assert artifacts & HISTOGRAM_ARTIFACTS == (HISTOGRAM_ARTIFACTS if make_plots else set())
+    image_artifacts = artifacts - HISTOGRAM_ARTIFACTS
+    if max_image_artifacts is None:
+        assert image_artifacts == IMAGE_ARTIFACTS
+    else:
+        # The perturbed and original versions of max_image_artifacts attacked images
+        assert image_artifacts <= IMAGE_ARTIFACTS and len(image_artifacts) == 2 * max_image_artifacts
+        assert len({artifact.split("_")[0] for artifact in image_artifacts}) == max_image_artifacts
+
+
+@pytest.mark.parametrize("max_images, saved_count", [(None, 3), (2, 2), (5, 3), (0, 0)])
+def test_save_adversarial_images_saves_a_reproducible_sample(tmp_path, max_images, saved_count):
+    robustness_check = FinishedRobustnessCheck()
+
+    saved_images = []
+    for folder in (tmp_path / "first", tmp_path / "second"):
+        folder.mkdir()
+        utils.save_adversarial_images(robustness_check, str(folder), max_images=max_images)
+        saved_images.append({path.name for path in folder.iterdir()})
+
+    # Each saved attacked image has a perturbed and an original version, and reruns save the same sample
+    assert saved_images[0] == saved_images[1]
+    assert saved_images[0] <= IMAGE_ARTIFACTS and len(saved_images[0]) == 2 * saved_count
+    assert len({name.split("_")[0] for name in saved_images[0]}) == saved_count
+
+
+@pytest.mark.parametrize("use_pyspng", [True, False])
+def test_save_image_round_trips_float_and_uint8_images(tmp_path, monkeypatch, use_pyspng):
+    Image = pytest.importorskip("PIL.Image")
+    if use_pyspng:
+        pytest.importorskip("pyspng")
+    else:
+        monkeypatch.setattr(utils, "png_encode", None)
+
+    uint8_img = np.random.RandomState(0).randint(0, 256, (6, 5, 3)).astype(np.uint8)
+    # Float images are clipped to [0, 255] and truncated to uint8
+    float_img = uint8_img + np.float32(0.75)
+    float_img[0, 0] = [-20.0, 255.5, 300.0]
+    expected_float_img = np.clip(float_img, 0, 255).astype(np.uint8)
+    # Single-channel images are saved as grayscale
+    images = [(uint8_img, uint8_img), (float_img, expected_float_img), (uint8_img[:, :, :1], uint8_img[:, :, 0])]
+
+    for img, expected_img in images:
+        fname = tmp_path / "image.png"
+        utils.save_image(str(fname), img)
+
+        with Image.open(fname) as saved_img:
+            np.testing.assert_array_equal(np.asarray(saved_img), expected_img)
+
+
+def test_save_histogram_reuses_the_shared_axes_without_leaking_bars(tmp_path):
+    pytest.importorskip("matplotlib")
+    rng = np.random.RandomState(0)
+
+    # 900 values are binned in 30 bars and 100 values in 10 bars
+    for values, bar_count in [(rng.randn(900), 30), (rng.randint(0, 50, 100), 10)]:
+        fname = tmp_path / f"histogram_{bar_count}.png"
+        fig = utils.save_histogram(values, str(fname), title="Histogram", clf=False)
+
+        with open(fname, "rb") as infile:
+            assert infile.read(8) == b"\x89PNG\r\n\x1a\n"
+        (ax,) = fig.axes
+        assert len(ax.patches) == bar_count
+        assert sum(patch.get_height() for patch in ax.patches) == len(values)
+
+    # By default, the shared axes are cleared once the histogram is saved
+    assert utils.save_histogram(rng.randn(100), str(tmp_path / "histogram.png"), title="Histogram") is fig
+    assert len(ax.patches) == 0